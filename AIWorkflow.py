@@ -4,13 +4,15 @@ import logging
 
 from datetime import datetime
 
-from BotData import UserInfo, MessageEvent, ReactionEvent, Message
+from BotData import UserInfo, MessageEvent, Message
 
 logging.basicConfig(level=logging.DEBUG)
 import Layer_1_Context_Gathering
 import Layer_2_Enrichment
 import Layer_3_Processing
 import Layer_4_Validation
+import StatusIndicator
+import Telemetry
 
 
 
@@ -25,19 +27,20 @@ import Layer_4_Validation
 
 async def AI_Phase_5_Request_Complete(bot_info: UserInfo, message_event: MessageEvent):
     logging.info("----AI Phase 5: Request Complete----")
-    new_reaction = ReactionEvent(reaction="phase_request_complete",message_id=message_event.message_id,channel_id=message_event.channel_id,user_id=bot_info.id,message_owner_id=message_event.user_id)
-    await bot_info.bot_functions.call_add_reaction(bot_info, new_reaction)
-    pass
+    StatusIndicator.finish(bot_info, message_event, "phase_request_complete")
 
 async def AI_Phase_6_Request_Failed(bot_info: UserInfo, message_event: MessageEvent):
     logging.info("----AI Phase 6: Request Failed----")
-    new_reaction = ReactionEvent(reaction="phase_request_failed",message_id=message_event.message_id,channel_id=message_event.channel_id,user_id=bot_info.id,message_owner_id=message_event.user_id)
-    await bot_info.bot_functions.call_add_reaction(bot_info, new_reaction)
+    StatusIndicator.finish(bot_info, message_event, "phase_request_failed")
 
 
 
 # This logic is called when a message is received by the bot and determines if the message should be processed by the LLM Workflow
 async def process_message_event(bot_info: UserInfo, message_event: MessageEvent):
+    # Everything done for this message, including the tasks it starts, is traced under one request id.
+    Telemetry.start_exporters()
+    request_id = Telemetry.new_request()
+    logging.info(f"Request {request_id}: message {message_event.message_id} in {bot_info.platform} channel {message_event.channel_id}")
     message_event.should_respond = False
     message_event.continued_conversation = False
     # Check for direct mention or direct message
@@ -62,14 +65,24 @@ async def process_message_event(bot_info: UserInfo, message_event: MessageEvent)
     # If the bot should respond, process the request
     if message_event.should_respond:        
         logging.info("Bot Should Respond")
-        # Collect event history and additional relevant context
-        event_context = await Layer_1_Context_Gathering.process_layer(bot_info, message_event)
-        # Enrich the event context with additional information such as terms or entities
-        event_context = await Layer_2_Enrichment.process_layer(bot_info, message_event, event_context)
-        # Process the event and context to determine a plan for the bot
-        processing_result = await Layer_3_Processing.process_layer(bot_info, message_event, event_context)
-        # Validate the processing result
-        validation_result = await Layer_4_Validation.process_layer(bot_info, message_event, event_context, processing_result)
+        try:
+            with Telemetry.span("request", bot_info.platform):
+                # Collect event history and additional relevant context
+                with Telemetry.span("phase", "context_gathering"):
+                    event_context = await Layer_1_Context_Gathering.process_layer(bot_info, message_event)
+                # Enrich the event context with additional information such as terms or entities
+                with Telemetry.span("phase", "enrichment"):
+                    event_context = await Layer_2_Enrichment.process_layer(bot_info, message_event, event_context)
+                # Process the event and context to determine a plan for the bot
+                with Telemetry.span("phase", "processing"):
+                    processing_result = await Layer_3_Processing.process_layer(bot_info, message_event, event_context)
+                # Validate the processing result
+                with Telemetry.span("phase", "validation"):
+                    validation_result = await Layer_4_Validation.process_layer(bot_info, message_event, event_context, processing_result)
+        except Exception:
+            # Don't leave the message showing a phase we'll never finish.
+            await AI_Phase_6_Request_Failed(bot_info, message_event)
+            raise
         # If the validation result is successful, continue to Phase 5. Otherwise, continue to Phase 6
         if validation_result:
             await AI_Phase_5_Request_Complete(bot_info, message_event)
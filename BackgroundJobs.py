@@ -0,0 +1,98 @@
+# Background job queue for work that can wait, like updating user profiles after a reply.
+# Jobs are submitted under a key (e.g. a user id) and run on the bot's event loop by a bounded number of workers. Each
+# key is debounced: a job only becomes due once nothing was submitted under its key for the debounce period, and
+# everything submitted in the meantime is handed over together. Due jobs of several keys are passed to the handler
+# as one batch. Workers hold off while interactive LLM requests are queued, and their LLM calls run at background
+# priority, so they never get in the way of answers.
+import os
+import time
+import asyncio
+import logging
+
+import LLMScheduler
+import Telemetry
+
+BACKGROUND_JOB_WORKERS = int(os.environ.get("BACKGROUND_JOB_WORKERS", "1"))
+# How often a worker checks whether interactive requests are still queued before starting a batch.
+INTERACTIVE_POLL_INTERVAL = 0.5
+
+
+def interactive_waiting():
+    """ True if interactive LLM requests are waiting for any model. """
+    depths = LLMScheduler.get_scheduler().queue_depths()
+    return any(depth.get(LLMScheduler.PRIORITY_NAMES[LLMScheduler.PRIORITY_INTERACTIVE], 0) for depth in depths.values())
+
+
+class BackgroundJobs:
+    def __init__(self, name, handler, debounce, batch_size=1, max_items=10, workers=BACKGROUND_JOB_WORKERS):
+        """ handler is a coroutine function taking a dict of key -> list of the items submitted for that key. """
+        self.name = name
+        self.handler = handler
+        self.debounce = debounce
+        self.batch_size = batch_size
+        self.max_items = max_items  # items kept per key; older ones are dropped
+        self.workers = workers
+        self.pending = {}  # key -> [due time, items]
+        self.active = set()  # keys whose jobs are running; their new items wait until they're done
+        self.running = []
+        self.wakeup = None
+        self.stats = {'submitted': 0, 'batches': 0, 'jobs': 0, 'errors': 0}
+        Telemetry.register_collector(self._collect_metrics)
+
+    def submit(self, key, item):
+        """ Queues item under key and (re)starts the key's debounce period. Returns immediately. """
+        self.stats['submitted'] += 1
+        due = time.monotonic() + self.debounce
+        if key in self.pending:
+            self.pending[key][0] = due
+            self.pending[key][1] = (self.pending[key][1] + [item])[-self.max_items:]
+        else:
+            self.pending[key] = [due, [item]]
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        self.wakeup.set()
+        self.running = [task for task in self.running if not task.done()]
+        if len(self.running) < self.workers:
+            self.running.append(asyncio.create_task(self._worker()))
+
+    def queue_depth(self):
+        return len(self.pending)
+
+    def _collect_metrics(self):
+        labels = {'queue': self.name}
+        samples = [("background_queue_depth", "gauge", labels, self.queue_depth())]
+        samples.extend((f"background_jobs_{counter}_total", "counter", labels, value) for counter, value in self.stats.items())
+        return samples
+
+    def _take_due(self):
+        now = time.monotonic()
+        due = sorted((entry[0], key) for key, entry in self.pending.items() if entry[0] <= now and key not in self.active)
+        return {key: self.pending.pop(key)[1] for _, key in due[:self.batch_size]}
+
+    async def _worker(self):
+        while self.pending:
+            if interactive_waiting():
+                await asyncio.sleep(INTERACTIVE_POLL_INTERVAL)
+                continue
+            batch = self._take_due()
+            if not batch:
+                # Sleep until the next key is due or something new is submitted.
+                self.wakeup.clear()
+                waiting = [entry[0] for key, entry in self.pending.items() if key not in self.active]
+                timeout = max(0.0, min(waiting) - time.monotonic()) if waiting else None
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.stats['batches'] += 1
+            self.stats['jobs'] += len(batch)
+            self.active.update(batch)
+            try:
+                await self.handler(batch)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logging.error(f"Error running {self.name} jobs for {list(batch)}: {e}")
+            finally:
+                self.active.difference_update(batch)
+                self.wakeup.set()
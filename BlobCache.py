@@ -0,0 +1,125 @@
+# Content-addressed on-disk cache for downloaded attachments and the text extracted from them.
+# Raw bytes are stored as files named after their sha256 under CACHE_PATH/blobs, while the url -> hash mapping,
+# the derived text (ocr_text, pdf_text) and the LRU bookkeeping live in a small SQLite index.
+import os
+import time
+import hashlib
+import logging
+import threading
+import LocalData
+import Telemetry
+
+BLOB_CACHE_PATH = os.path.join(LocalData.CACHE_PATH, "blobs")
+if not os.path.exists(BLOB_CACHE_PATH):
+    os.makedirs(BLOB_CACHE_PATH)
+
+BLOB_CACHE_MAX_BYTES = int(os.environ.get("BLOB_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+_lock = threading.Lock()
+_db = LocalData.open_cache_db("blob_cache.db")
+_db.executescript("""
+    CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, content_hash TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS blobs (content_hash TEXT PRIMARY KEY, size INTEGER NOT NULL, last_access REAL NOT NULL);
+    CREATE TABLE IF NOT EXISTS derived (content_hash TEXT NOT NULL, kind TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (content_hash, kind));
+    CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access);
+    CREATE INDEX IF NOT EXISTS urls_content_hash ON urls (content_hash);
+""")
+_db.commit()
+
+stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+Telemetry.register_cache("blob", stats)
+
+
+def _blob_path(content_hash):
+    return os.path.join(BLOB_CACHE_PATH, content_hash[:2], content_hash)
+
+
+def get_blob_for_url(url):
+    """ Returns (content_hash, data) for a previously downloaded url, or None. """
+    with _lock:
+        row = _db.execute("SELECT content_hash FROM urls WHERE url = ?", (url,)).fetchone()
+    if row is None:
+        stats['misses'] += 1
+        return None
+    data = get_blob(row[0])
+    if data is None:
+        stats['misses'] += 1
+        return None
+    stats['hits'] += 1
+    return row[0], data
+
+
+def get_blob(content_hash):
+    try:
+        with open(_blob_path(content_hash), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    with _lock:
+        _db.execute("UPDATE blobs SET last_access = ? WHERE content_hash = ?", (time.time(), content_hash))
+        _db.commit()
+    return data
+
+
+def put_blob(url, data):
+    """ Stores the bytes downloaded from url and returns their content hash. """
+    content_hash = hashlib.sha256(data).hexdigest()
+    path = _blob_path(content_hash)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so other processes never read a partial blob.
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    with _lock:
+        _db.execute("INSERT INTO blobs (content_hash, size, last_access) VALUES (?, ?, ?) ON CONFLICT(content_hash) DO UPDATE SET last_access = excluded.last_access", (content_hash, len(data), time.time()))
+        _db.execute("INSERT OR REPLACE INTO urls (url, content_hash) VALUES (?, ?)", (url, content_hash))
+        _db.commit()
+        _evict()
+    return content_hash
+
+
+def get_text(content_hash, kind):
+    """ Returns text previously derived from a blob (e.g. 'ocr_text' or 'pdf_text'), or None. """
+    if not content_hash:
+        return None
+    with _lock:
+        row = _db.execute("SELECT value FROM derived WHERE content_hash = ? AND kind = ?", (content_hash, kind)).fetchone()
+    if row is None:
+        stats['misses'] += 1
+        return None
+    stats['hits'] += 1
+    return row[0]
+
+
+def put_text(content_hash, kind, text):
+    if not content_hash:
+        return
+    with _lock:
+        _db.execute("INSERT OR REPLACE INTO derived (content_hash, kind, value) VALUES (?, ?, ?)", (content_hash, kind, text))
+        _db.commit()
+
+
+def _evict():
+    # Drop least recently used blobs (and everything derived from them) until we're under the size cap.
+    # Must be called with _lock held.
+    total = _db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+    if total <= BLOB_CACHE_MAX_BYTES:
+        return
+    for content_hash, size in _db.execute("SELECT content_hash, size FROM blobs ORDER BY last_access").fetchall():
+        if total <= BLOB_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(_blob_path(content_hash))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(f"Error evicting blob {content_hash}: {e}")
+            continue
+        _db.execute("DELETE FROM blobs WHERE content_hash = ?", (content_hash,))
+        _db.execute("DELETE FROM urls WHERE content_hash = ?", (content_hash,))
+        _db.execute("DELETE FROM derived WHERE content_hash = ?", (content_hash,))
+        total -= size
+        stats['evictions'] += 1
+    _db.commit()
@@ -2,6 +2,7 @@ from dataclasses import dataclass, field, asdict
 from typing import Optional,  Any, List
 import asyncio
 import inspect
+import Telemetry
 
 
 # Represents a user's information
@@ -47,6 +48,7 @@ class EmbeddedFile:
     ocr_text: str = ""
     summary: str = ""
     file_data: Optional[Any] = None  # Can hold any file data
+    content_hash: str = ""  # sha256 of the downloaded file contents
 
     def __str__(self):
         return f"EmbeddedFile:\nName: {self.name}\nURL: {self.url}\nType: {self.file_type}\n"
@@ -68,6 +70,7 @@ class ReactionEvent:
     message_owner_id: Optional[str] = None  # The user id of the message owner
     channel_id: Optional[str] = None  # The id of the channel the message is in
     notes: str = ""  # Notes for AI about the Reaction
+    count: int = 1  # Number of users who reacted; when user_id is None the users haven't been resolved
 
     def __str__(self):
         return (f"ReactionEvent:\nReaction: {self.reaction}\nUser ID: {self.user_id}\n"
@@ -109,6 +112,7 @@ class Message:
     channel: Optional[str] = None  # Channel ID for Slack or Discord
     thread_id: Optional[str] = None  # Thread ID if the message is for a thread
     attachments: List[str] = field(default_factory=list)  # List of attachment URLs or IDs
+    message_id: Optional[str] = None  # ID of an already sent message, when updating it
 
     def __str__(self):
         attachments_str = ', '.join(self.attachments) if self.attachments else 'None'
@@ -120,7 +124,10 @@ class Message:
 # Method Adapter for Various Providers
 class ProviderFunctionsBase:
     def __init__(self):
+        # Longest message text the provider accepts in a single message.
+        self.max_message_length = 2000
         self.send_message = None
+        self.update_message = None
         self.add_reaction = None
         self.remove_reaction = None
         self.get_user_info = None
@@ -129,8 +136,18 @@ class ProviderFunctionsBase:
         self.get_message_info = None
         self.get_thread_participants = None
         self.get_previous_messages = None
-
-    async def async_adapter(self, method, *args, **kwargs):
+        self.resolve_reaction_users = None
+        # Optional OutboundQueue that paces the calls to the provider's API.
+        self.outbound_queue = None
+
+    async def async_adapter(self, method, *args, rate_limit_channel=None, **kwargs):
+        with Telemetry.span("provider", method.__name__):
+            if self.outbound_queue is not None:
+                # Calls are rate limited per provider function, and per channel where rate_limit_channel is given.
+                return await self.outbound_queue.call(method.__name__, lambda: self._invoke(method, *args, **kwargs), channel_id=rate_limit_channel)
+            return await self._invoke(method, *args, **kwargs)
+
+    async def _invoke(self, method, *args, **kwargs):
         if inspect.iscoroutinefunction(method):
             return await method(*args, **kwargs)
         else:
@@ -138,13 +155,16 @@ class ProviderFunctionsBase:
             return await loop.run_in_executor(None, method, *args, **kwargs)
 
     async def call_send_message(self, bot, message):
-        await self.async_adapter(self.send_message, bot, message)
+        return await self.async_adapter(self.send_message, bot, message, rate_limit_channel=message.channel)
+
+    async def call_update_message(self, bot, message):
+        return await self.async_adapter(self.update_message, bot, message, rate_limit_channel=message.channel)
 
     async def call_add_reaction(self, bot, reaction):
-        await self.async_adapter(self.add_reaction, bot, reaction)
+        await self.async_adapter(self.add_reaction, bot, reaction, rate_limit_channel=reaction.channel_id)
 
     async def call_remove_reaction(self, bot, reaction):
-        await self.async_adapter(self.remove_reaction, bot, reaction)
+        await self.async_adapter(self.remove_reaction, bot, reaction, rate_limit_channel=reaction.channel_id)
 
     async def call_get_user_info(self, bot, user_id):
         return await self.async_adapter(self.get_user_info, bot, user_id)
@@ -161,5 +181,11 @@ class ProviderFunctionsBase:
     async def call_get_thread_participants(self, bot, channel_id, thread_id):
         return await self.async_adapter(self.get_thread_participants, bot, channel_id, thread_id)
     
+    async def call_resolve_reaction_users(self, bot, messages):
+        # Optional: providers that only report reaction counts can fill in who reacted.
+        if self.resolve_reaction_users is None or not messages:
+            return
+        await self.async_adapter(self.resolve_reaction_users, bot, messages)
+
     async def call_get_previous_messages(self, bot, channel_id, message_id, thread_id):
         return await self.async_adapter(self.get_previous_messages, bot, channel_id, message_id, thread_id)
\ No newline at end of file
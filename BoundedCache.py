@@ -0,0 +1,70 @@
+# SQLite-backed cache with a lifetime and a size cap, shared by the response and image description caches.
+# Each cache is one table of text values under a (possibly compound) text key. Entries older than the TTL are misses,
+# and eviction - expired entries first, then the least recently used beyond the entry cap - runs every
+# eviction_interval inserts, since it has to count the whole table. All calls block on SQLite, so async code runs them
+# with asyncio.to_thread.
+import time
+import threading
+import LocalData
+
+
+class BoundedCache:
+    def __init__(self, filename, table, key_columns, value_column, ttl, max_entries, eviction_interval=1000):
+        self.table = table
+        self.key_columns = tuple(key_columns)
+        self.value_column = value_column
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.eviction_interval = eviction_interval
+        self.inserts_since_eviction = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._key_match = " AND ".join(f"{column} = ?" for column in key_columns)
+        self._lock = threading.Lock()
+        self._db = LocalData.open_cache_db(filename)
+        key_definitions = "".join(f"{column} TEXT NOT NULL, " for column in key_columns)
+        self._db.executescript(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                {key_definitions}{value_column} TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY ({", ".join(key_columns)})
+            );
+            CREATE INDEX IF NOT EXISTS {table}_last_access ON {table} (last_access);
+        """)
+        self._db.commit()
+
+    def lookup(self, *key):
+        """ Returns the value stored under key, or None if there's none or it has expired. """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(f"SELECT {self.value_column}, created FROM {self.table} WHERE {self._key_match}", key).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.stats['misses'] += 1
+                return None
+            self._db.execute(f"UPDATE {self.table} SET last_access = ? WHERE {self._key_match}", (now, *key))
+            self._db.commit()
+        self.stats['hits'] += 1
+        return row[0]
+
+    def add(self, *key_and_value):
+        """ Stores the value under key: add(key part, ..., value). """
+        now = time.time()
+        columns = ", ".join(self.key_columns + (self.value_column, "created", "last_access"))
+        placeholders = ", ".join("?" * (len(key_and_value) + 2))
+        with self._lock:
+            self._db.execute(f"INSERT OR REPLACE INTO {self.table} ({columns}) VALUES ({placeholders})", (*key_and_value, now, now))
+            self._db.commit()
+            self.inserts_since_eviction += 1
+            if self.inserts_since_eviction >= self.eviction_interval:
+                self.inserts_since_eviction = 0
+                self._evict(now)
+
+    def _evict(self, now):
+        # Called with _lock held.
+        expired = self._db.execute(f"DELETE FROM {self.table} WHERE created < ?", (now - self.ttl,)).rowcount
+        count = self._db.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        overflow = max(0, count - self.max_entries)
+        if overflow:
+            self._db.execute(f"DELETE FROM {self.table} WHERE rowid IN (SELECT rowid FROM {self.table} ORDER BY last_access LIMIT ?)", (overflow,))
+        self._db.commit()
+        self.stats['evictions'] += expired + overflow
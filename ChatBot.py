@@ -1,13 +1,14 @@
+import os
 import logging
 import time
 import traceback
 from BotData import ReactionEvent, Message
 
-import SlackProvider
-import DiscordProvider
-
 import AIWorkflow
 
+# Run the Slack bot on the native asyncio provider instead of the thread-based one.
+SLACK_ASYNC_MODE = os.environ.get("SLACK_ASYNC_MODE", "false").lower() in ("1", "true", "yes")
+
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -87,12 +88,19 @@ async def event_handler(bot_info, event_type, event_data):
     else:
         logging.warn("Received an unhandled " + event_type + " event")
 
+# Providers connect to their platform when imported, so only the one being run is imported.
 def run_slack():
     global event_handler
-    bot = SlackProvider.create_bot(event_handler)
+    if SLACK_ASYNC_MODE:
+        import SlackAsyncProvider
+        bot = SlackAsyncProvider.create_bot(event_handler)
+    else:
+        import SlackProvider
+        bot = SlackProvider.create_bot(event_handler)
 
 def run_discord():
     global event_handler
+    import DiscordProvider
     bot = DiscordProvider.create_bot(event_handler)
 
 
@@ -0,0 +1,150 @@
+# Management of per-thread Conversation State
+# Each conversation the bot takes part in gets a ThreadState that remembers the messages it has already fetched,
+# downloaded and enriched, along with their rendered transcript lines. A continued conversation then only fetches and
+# processes the messages that are new since the last turn. States are kept in memory and bounded both in the number of
+# threads (least recently used first) and in the number of messages per thread (oldest first).
+import os
+from collections import OrderedDict
+from BotData import MessageEvent
+
+CONVERSATION_STATE_MAX_THREADS = int(os.environ.get("CONVERSATION_STATE_MAX_THREADS", "500"))
+CONVERSATION_STATE_MAX_MESSAGES = int(os.environ.get("CONVERSATION_STATE_MAX_MESSAGES", "200"))
+
+
+def message_order(message_id):
+    # Slack timestamps ("1700000000.000100") and Discord snowflakes both sort chronologically this way.
+    return tuple(int(part) for part in str(message_id).split("."))
+
+
+class ThreadState:
+    def __init__(self, key):
+        self.key = key
+        self.messages = {}  # message id -> MessageEvent
+        self.aliases = {}  # extra ids of multi-part bot replies -> message id
+        self.transcript_lines = {}  # message id -> rendered transcript lines
+
+    def __contains__(self, message_id):
+        return message_id in self.messages or message_id in self.aliases
+
+    def resolve(self, message_id):
+        return self.aliases.get(message_id, message_id)
+
+    def add_message(self, message: MessageEvent, aliases=()):
+        if message.message_id is None or message.message_id in self:
+            return
+        self.messages[message.message_id] = message
+        for alias in aliases:
+            self.aliases[alias] = message.message_id
+            _index_message(self, alias)
+        _index_message(self, message.message_id)
+        self._trim()
+
+    def add_reply(self, bot_id, message_event: MessageEvent, text, message_ids):
+        """ Records the bot's reply to message_event, which may have been sent as several messages. """
+        message_ids = [message_id for message_id in message_ids if message_id is not None]
+        if not message_ids:
+            return
+        reply = MessageEvent(text=text, user_id=bot_id, message_id=message_ids[0], channel_id=message_event.channel_id)
+        reply.thread_id = message_event.thread_id
+        reply.parent_message_id = message_event.message_id
+        self.add_message(reply, aliases=message_ids[1:])
+
+    def add_fetched_messages(self, messages, exclude_id=None) -> list[MessageEvent]:
+        """ Adds the messages we haven't seen yet and returns them; they still need their files processed.
+
+        Messages are matched by id rather than against the newest one we know of, since replies posted while we were
+        answering (or that never triggered a request) can be older than our own last reply.
+        """
+        new_messages = []
+        for message in messages or []:
+            if message.message_id is None or message.message_id == exclude_id or message.message_id in self:
+                continue
+            new_messages.append(message)
+        for message in sorted(new_messages, key=lambda message: message_order(message.message_id)):
+            self.add_message(message)
+        return new_messages
+
+    def history(self, message_event: MessageEvent, reply_chain=False) -> list[MessageEvent]:
+        """ Returns the messages before message_event in chronological order.
+
+        For reply chains (Discord) only the ancestors of the message are included, for threads (Slack) everything.
+        """
+        if reply_chain:
+            chain = []
+            message_id = self.resolve(message_event.parent_message_id)
+            while message_id in self.messages and len(chain) < len(self.messages):
+                chain.append(self.messages[message_id])
+                message_id = self.resolve(self.messages[message_id].parent_message_id)
+            chain.reverse()
+            return chain
+        current = message_order(message_event.message_id) if message_event.message_id is not None else None
+        messages = [message for message_id, message in self.messages.items() if message_id != message_event.message_id and (current is None or message_order(message_id) < current)]
+        return sorted(messages, key=lambda message: message_order(message.message_id))
+
+    def get_transcript_lines(self, message: MessageEvent, render) -> str:
+        lines = self.transcript_lines.get(message.message_id)
+        if lines is None:
+            lines = render(message)
+            if message.message_id in self.messages:
+                self.transcript_lines[message.message_id] = lines
+        return lines
+
+    def release_file_data(self, messages):
+        # Only the extracted text and summaries of enriched files are needed later, so don't hold on to their contents.
+        for message in messages:
+            if message.message_id in self.messages:
+                for file in message.files:
+                    file.file_data = None
+
+    def _trim(self):
+        overflow = len(self.messages) - CONVERSATION_STATE_MAX_MESSAGES
+        if overflow <= 0:
+            return
+        for message_id in sorted(self.messages, key=message_order)[:overflow]:
+            del self.messages[message_id]
+            self.transcript_lines.pop(message_id, None)
+            _unindex_message(self, message_id)
+        for alias, message_id in list(self.aliases.items()):
+            if message_id not in self.messages:
+                del self.aliases[alias]
+                _unindex_message(self, alias)
+
+
+# thread key -> ThreadState, in least recently used order
+_threads = OrderedDict()
+# (platform, channel id, message id) -> thread key, so replies can find the conversation they belong to.
+_message_index = {}
+
+
+def _index_message(state, message_id):
+    platform, channel_id, _ = state.key
+    _message_index[(platform, channel_id, message_id)] = state.key
+
+def _unindex_message(state, message_id):
+    platform, channel_id, _ = state.key
+    if _message_index.get((platform, channel_id, message_id)) == state.key:
+        del _message_index[(platform, channel_id, message_id)]
+
+
+def get_thread_state(platform, message_event: MessageEvent) -> ThreadState:
+    """ Returns the state of the conversation message_event belongs to, creating it if this is a new conversation. """
+    channel_id = message_event.channel_id
+    if platform == "slack":
+        # Slack threads are identified by the timestamp of their parent message; a top-level message starts one.
+        key = (platform, channel_id, message_event.thread_id or message_event.message_id)
+    else:
+        # Discord conversations are reply chains, so follow the reply to the conversation its parent is part of.
+        key = _message_index.get((platform, channel_id, message_event.parent_message_id))
+        if key not in _threads:
+            key = (platform, channel_id, message_event.message_id)
+
+    state = _threads.get(key)
+    if state is None:
+        state = ThreadState(key)
+        _threads[key] = state
+        while len(_threads) > CONVERSATION_STATE_MAX_THREADS:
+            _, evicted = _threads.popitem(last=False)
+            for message_id in list(evicted.messages) + list(evicted.aliases):
+                _unindex_message(evicted, message_id)
+    _threads.move_to_end(key)
+    return state
@@ -0,0 +1,137 @@
+# Rolling Conversation Summaries
+# In summary mode, the older turns of a conversation are folded into a running summary that's persisted per thread, and
+# prompts only carry that summary plus the last CONVERSATION_SUMMARY_RECENT_MESSAGES messages verbatim. The summary is
+# updated after each reply as a background job, one update per thread at a time, at background LLM priority. Messages
+# that haven't been folded in yet are kept verbatim, so nothing drops out of the prompt while an update is pending.
+import os
+import time
+import asyncio
+import logging
+import threading
+
+import LocalData
+import LLMFoundation
+import BackgroundJobs
+from LLMScheduler import PRIORITY_BACKGROUND
+from ConversationState import ThreadState, message_order
+
+CONVERSATION_SUMMARY = os.environ.get("CONVERSATION_SUMMARY", "false").lower() in ("1", "true", "yes")
+CONVERSATION_SUMMARY_RECENT_MESSAGES = int(os.environ.get("CONVERSATION_SUMMARY_RECENT_MESSAGES", "10"))
+# Most messages folded into the summary by one LLM call; a long backlog is folded in several steps.
+CONVERSATION_SUMMARY_BATCH = 40
+
+SUMMARY_PROMPT = """Below is the summary of a conversation so far, followed by the messages that came after it.
+Write an updated summary that includes the new messages. Keep who said what (by user id), facts, decisions, requests and open questions; leave out greetings and small talk.
+Respond with the updated summary only, in at most 250 words.
+
+Summary so far:
+{summary}
+
+New messages:
+{messages}
+Updated summary: """
+
+_lock = threading.Lock()
+_db = LocalData.open_cache_db("conversation_summaries.db")
+_db.executescript("""
+    CREATE TABLE IF NOT EXISTS summaries (
+        thread_key TEXT PRIMARY KEY,
+        summary TEXT NOT NULL,
+        last_message_id TEXT NOT NULL,
+        updated REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS summary_messages (
+        message_key TEXT PRIMARY KEY,
+        thread_key TEXT NOT NULL
+    );
+""")
+_db.commit()
+
+
+def _key(platform, channel_id, message_id):
+    return f"{platform}|{channel_id}|{message_id}"
+
+
+def thread_key(thread_state: ThreadState, messages):
+    """ Key of the thread's summary; messages is the conversation in chronological order. """
+    platform, channel_id, root_id = thread_state.key
+    if platform != "discord" or not messages:
+        return _key(platform, channel_id, root_id)
+    # A Discord conversation's state is keyed by whichever message started it in this process, which is a later message
+    # after a restart, and a long reply chain is only fetched back so far. So the summary is found through any message
+    # that was folded into it, and a new summary is keyed by the first message of the chain.
+    keys = [_key(platform, channel_id, message.message_id) for message in messages if message.message_id is not None]
+    if keys:
+        with _lock:
+            row = _db.execute(f"SELECT thread_key FROM summary_messages WHERE message_key IN ({', '.join('?' * len(keys))}) LIMIT 1", keys).fetchone()
+        if row is not None:
+            return row[0]
+    return _key(platform, channel_id, messages[0].message_id)
+
+
+def get_summary(key):
+    """ Returns (summary, id of the last message folded into it) for a thread, or None. """
+    with _lock:
+        return _db.execute("SELECT summary, last_message_id FROM summaries WHERE thread_key = ?", (key,)).fetchone()
+
+
+def store_summary(key, summary, message_ids):
+    """ Stores the summary of a thread; message_ids are the (chronological) ids of the messages just folded into it. """
+    platform, channel_id, _ = key.split("|", 2)
+    with _lock:
+        _db.execute("INSERT OR REPLACE INTO summaries (thread_key, summary, last_message_id, updated) VALUES (?, ?, ?, ?)", (key, summary, str(message_ids[-1]), time.time()))
+        _db.executemany("INSERT OR REPLACE INTO summary_messages (message_key, thread_key) VALUES (?, ?)", [(_key(platform, channel_id, message_id), key) for message_id in message_ids])
+        _db.commit()
+
+
+async def split_history(thread_state: ThreadState, previous_messages):
+    """ Returns the summary of the conversation (or None) and the previous messages that still go in verbatim. """
+    if not CONVERSATION_SUMMARY or len(previous_messages) <= CONVERSATION_SUMMARY_RECENT_MESSAGES:
+        return None, previous_messages
+    # The summary database is only touched from worker threads, so the event loop never waits on SQLite.
+    key = await asyncio.to_thread(thread_key, thread_state, previous_messages)
+    row = await asyncio.to_thread(get_summary, key)
+    if row is None:
+        return None, previous_messages
+    summary, last_message_id = row
+    recent_start = len(previous_messages) - CONVERSATION_SUMMARY_RECENT_MESSAGES
+    summarized = message_order(last_message_id)
+    recent = [message for i, message in enumerate(previous_messages) if i >= recent_start or message_order(message.message_id) > summarized]
+    return summary, recent
+
+
+async def _fold(key, messages):
+    # Fold everything but the recent messages that isn't in the summary yet.
+    row = await asyncio.to_thread(get_summary, key)
+    summary, last_message_id = row if row is not None else ("", None)
+    older = messages[:-CONVERSATION_SUMMARY_RECENT_MESSAGES] if CONVERSATION_SUMMARY_RECENT_MESSAGES else messages
+    pending = [(message_id, lines) for message_id, lines in older if last_message_id is None or message_order(message_id) > message_order(last_message_id)]
+    for start in range(0, len(pending), CONVERSATION_SUMMARY_BATCH):
+        batch = pending[start:start + CONVERSATION_SUMMARY_BATCH]
+        prompt = SUMMARY_PROMPT.format(summary=summary or "(none yet)", messages="".join(lines for _, lines in batch))
+        summary = (await LLMFoundation.text_ask_local_llm(prompt, temperature=0.2, priority=PRIORITY_BACKGROUND)).strip()
+        await asyncio.to_thread(store_summary, key, summary, [message_id for message_id, _ in batch])
+        logging.info(f"Folded {len(batch)} messages into the summary of {key}")
+
+
+async def _fold_batch(batch):
+    # Only the latest conversation of each thread matters; it includes the earlier ones.
+    for key, conversations in batch.items():
+        try:
+            await _fold(key, conversations[-1])
+        except Exception as e:
+            logging.error(f"Error updating the summary of {key}: {e}")
+
+
+# Updates of a thread are queued under its key, so a thread never has two updates running at once.
+summary_jobs = BackgroundJobs.BackgroundJobs("conversation summary", _fold_batch, debounce=0, max_items=1)
+
+
+async def schedule_update(thread_state: ThreadState, conversation, render):
+    """ Folds the older messages of conversation (chronological, including the latest reply) into the thread's summary
+    in the background. render(message) renders a message's transcript lines. Returns once the update is queued. """
+    if not CONVERSATION_SUMMARY or len(conversation) <= CONVERSATION_SUMMARY_RECENT_MESSAGES:
+        return
+    # Rendered now, while the messages are sure to be in the thread state.
+    messages = [(message.message_id, thread_state.get_transcript_lines(message, render)) for message in conversation if message.message_id is not None]
+    summary_jobs.submit(await asyncio.to_thread(thread_key, thread_state, conversation), messages)
@@ -7,7 +7,31 @@ import emoji
 from BotData import UserInfo, ReactionEvent, MessageEvent, EmbeddedFile, EmbeddedLink, Message, ProviderFunctionsBase
 import logging
 import UserProfile
+import OutboundQueue
 import asyncio
+from collections import OrderedDict
+
+# Longest reply chain followed when gathering the previous messages of a conversation.
+MAX_REPLY_CHAIN_DEPTH = int(os.environ.get("MAX_REPLY_CHAIN_DEPTH", "50"))
+# Number of recent messages kept in MESSAGE_CACHE, and how many messages are fetched at once on a cache miss.
+MESSAGE_CACHE_SIZE = int(os.environ.get("DISCORD_MESSAGE_CACHE_SIZE", "5000"))
+HISTORY_PAGE_SIZE = int(os.environ.get("DISCORD_HISTORY_PAGE_SIZE", "100"))
+# Messages only carry reaction counts; looking up who reacted costs a REST call per reaction, so it's opt-in and only
+# done for messages that go into a conversation transcript.
+RESOLVE_REACTION_USERS = os.environ.get("DISCORD_RESOLVE_REACTION_USERS", "false").lower() in ("1", "true", "yes")
+REACTION_USERS_CACHE_SIZE = 10000
+REACTION_RESOLVE_CONCURRENCY = 4
+# Outbound pacing, as (calls per second, burst). discord.py already follows the buckets Discord reports, but it sends
+# calls in whatever order they're made; pacing them here below Discord's limits lets answers go ahead of status
+# reactions. Only the 50 requests per second limit applies to the whole bot; messages (about 5 per 5 seconds) and
+# reactions (one per 0.25 seconds) are limited per channel.
+DISCORD_GLOBAL_RATE_LIMIT = (50.0, 50)
+DISCORD_CHANNEL_RATE_LIMITS = {
+    'send_message': (1.0, 5),
+    'update_message': (1.0, 5),
+    'add_reaction': (4.0, 1),
+    'remove_reaction': (4.0, 1),
+}
 
 REACTION_DB = {
     'phase_context_gathering': emoji.emojize(':eyes:',language='alias'),
@@ -25,6 +49,40 @@ REACTION_DB = {
     'process_image':emoji.emojize(':frame_with_picture:',language='alias'),
 }
 
+# Recently seen messages by id, filled from gateway events and history pages so reply chains can mostly be walked
+# without a REST call per hop.
+MESSAGE_CACHE = OrderedDict()
+
+def discord_retry_after(exception):
+    """ Seconds to wait before retrying if exception is a rate-limit error (HTTP 429), otherwise None. """
+    if not isinstance(exception, discord.HTTPException) or exception.status != 429:
+        return None
+    retry_after = getattr(exception, "retry_after", None) or exception.response.headers.get("Retry-After", 1)
+    return float(retry_after)
+
+
+def cache_message(message):
+    MESSAGE_CACHE[message.id] = message
+    MESSAGE_CACHE.move_to_end(message.id)
+    while len(MESSAGE_CACHE) > MESSAGE_CACHE_SIZE:
+        MESSAGE_CACHE.popitem(last=False)
+
+async def get_message(channel, message_id):
+    """ Returns the message from the cache, or fetches the page of history that ends with it. None if it's gone. """
+    message = MESSAGE_CACHE.get(message_id)
+    if message is not None:
+        return message
+    # The messages just before this one are most likely the next hops of the chain, so fetch them along with it.
+    async for history_message in channel.history(limit=HISTORY_PAGE_SIZE, before=discord.Object(id=message_id + 1)):
+        cache_message(history_message)
+    return MESSAGE_CACHE.get(message_id)
+
+def reaction_name(reaction_emoji):
+    # Unicode emoji come as strings, custom emoji as objects with a name.
+    if isinstance(reaction_emoji, str):
+        return emoji.demojize(reaction_emoji, delimiters=("", ""))
+    return reaction_emoji.name
+
 def convert_reaction(reaction_text):
     reaction_emoji = REACTION_DB.get(reaction_text,None)
     if reaction_emoji is not None:
@@ -63,16 +121,16 @@ async def convert_discord_message_to_message_event(bot_info, message):
     message_info.files = [EmbeddedFile(name=attachment.filename, url=attachment.url, file_type=attachment.content_type) for attachment in message.attachments]
     message_info.links = [EmbeddedLink(url=embed.url) for embed in message.embeds]
 
+    # Only the emoji and count of each reaction; see resolve_reaction_users for who reacted.
     message_info.reactions = []
     for reaction in message.reactions:
-        users = [user async for user in reaction.users()]
-        for user in users:
-            reaction_event = ReactionEvent(
-                reaction=REACTION_DB.get(reaction.emoji, None),
-                user_id=user.id,
-                message_id=message.id
-            )
-            message_info.reactions.append(reaction_event)
+        reaction_event = ReactionEvent(
+            reaction=reaction_name(reaction.emoji),
+            message_id=message.id,
+            channel_id=message.channel.id,
+            count=reaction.count
+        )
+        message_info.reactions.append(reaction_event)
 
     return message_info
 
@@ -109,7 +167,7 @@ async def send_message(bot: UserInfo, message: Message):
 
     # Function to send a message chunk
     async def send_chunk(chunk, parent_message=None):
-        await channel.send(chunk, reference=parent_message)
+        return await channel.send(chunk, reference=parent_message)
 
     # If message is a reply, fetch the parent message
     parent_message = None
@@ -124,8 +182,23 @@ async def send_message(bot: UserInfo, message: Message):
         chunks = [message.text]
 
     # Send each chunk
+    sent_message = None
     for chunk in chunks:
-        await send_chunk(chunk, parent_message)
+        sent_message = await send_chunk(chunk, parent_message)
+
+    # Return the ID of the last message sent
+    return sent_message.id if sent_message else None
+
+
+async def update_message(bot: UserInfo, message: Message):
+    channel = bot.bot_client.get_channel(message.channel)
+    if channel is None:
+        logging.error(f"Could not find channel with ID {message.channel}")
+        return None
+
+    # Edit through a partial message so we don't have to fetch the message first
+    await channel.get_partial_message(message.message_id).edit(content=message.text)
+    return message.message_id
 
 
 async def add_reaction(bot: UserInfo, reaction: ReactionEvent) -> None:
@@ -148,6 +221,9 @@ async def add_reaction(bot: UserInfo, reaction: ReactionEvent) -> None:
         await message.add_reaction(convert_reaction(reaction.reaction))
 
     except Exception as e:
+        # Let the outbound queue retry rate-limited calls.
+        if discord_retry_after(e) is not None:
+            raise
         logging.error(f"Error in add_reaction {reaction.reaction}: {str(e)}")
 
 
@@ -161,6 +237,8 @@ async def remove_reaction(bot: UserInfo, reaction: ReactionEvent) -> None:
         message = await channel.fetch_message(reaction.message_id)
         await message.remove_reaction(convert_reaction(reaction.reaction), member=bot.bot_client.user)
     except Exception as e:
+        if discord_retry_after(e) is not None:
+            raise
         logging.error(f"Error adding reaction: {e}")   
 
 
@@ -168,6 +246,7 @@ async def get_messages_from_channel(bot: UserInfo, channel_id: str) -> list:
     channel = bot.bot_client.get_channel(channel_id)
     messages = []
     async for message in channel.history(limit=100):
+        cache_message(message)
         message_event = await convert_discord_message_to_message_event(bot,message)
         messages.append(message_event)
     messages.reverse()
@@ -186,6 +265,7 @@ async def get_messages_from_thread(bot: UserInfo, channel_id: str, thread_id: st
     # Now fetch messages from the thread channel
     messages = []
     async for message in thread_channel.history(limit=100):
+        cache_message(message)
         message_event = await convert_discord_message_to_message_event(bot,message)
         messages.append(message_event)
     messages.reverse()
@@ -193,7 +273,10 @@ async def get_messages_from_thread(bot: UserInfo, channel_id: str, thread_id: st
 
 async def get_message_info(bot: UserInfo, channel_id: str, message_id: str) -> Message:
     channel = bot.bot_client.get_channel(channel_id)
-    message = await channel.fetch_message(message_id)
+    message = await get_message(channel, message_id)
+    if message is None:
+        logging.error(f"Message not found: {message_id}")
+        return None
     message_info = await convert_discord_message_to_message_event(bot,message)
     return message_info
 
@@ -204,20 +287,71 @@ async def get_previous_messages(bot: UserInfo,  channel_id: str, message_id: str
         logging.error(f"Channel not found: {channel_id}")
         return []
 
-    messages = []
-    async def fetch_replies(msg_id):
-        msg = await channel.fetch_message(msg_id)
-        if msg.reference and msg.reference.message_id:
-            messages.append(await convert_discord_message_to_message_event(bot,msg))
-            await fetch_replies(msg.reference.message_id)
-
-    await fetch_replies(message_id)
+    # Walk up the reply chain, oldest ancestor last, stopping at the root or at the depth limit.
+    chain = []
+    message = await get_message(channel, message_id)
+    while message is not None and message.reference and message.reference.message_id and len(chain) < MAX_REPLY_CHAIN_DEPTH:
+        parent_id = message.reference.message_id
+        # Gateway events usually carry the message being replied to.
+        if isinstance(message.reference.resolved, discord.Message):
+            cache_message(message.reference.resolved)
+        try:
+            message = await get_message(channel, parent_id)
+        except discord.HTTPException as e:
+            logging.error(f"Error fetching message {parent_id}: {e}")
+            break
+        if message is not None:
+            chain.append(message)
+
+    chain.reverse()
+    return [await convert_discord_message_to_message_event(bot, message) for message in chain]
+
+# (message id, reaction name, count) -> ids of the users who reacted. The count is part of the key, so a changed
+# reaction is looked up again.
+REACTION_USERS_CACHE = OrderedDict()
+
+async def resolve_reaction_users(bot: UserInfo, message_events: list[MessageEvent]) -> None:
+    """ Replaces the reaction counts of the given messages with one ReactionEvent per user who reacted. """
+    semaphore = asyncio.Semaphore(REACTION_RESOLVE_CONCURRENCY)
+
+    async def get_reaction_users(message, reaction, name):
+        key = (message.id, name, reaction.count)
+        user_ids = REACTION_USERS_CACHE.get(key)
+        if user_ids is None:
+            async with semaphore:
+                user_ids = [user.id async for user in reaction.users()]
+            REACTION_USERS_CACHE[key] = user_ids
+            while len(REACTION_USERS_CACHE) > REACTION_USERS_CACHE_SIZE:
+                REACTION_USERS_CACHE.popitem(last=False)
+        return user_ids
+
+    async def resolve(message_event):
+        if all(reaction.user_id is not None for reaction in message_event.reactions):
+            return
+        try:
+            async with semaphore:
+                # Channels the client hasn't cached (such as threads it hasn't seen yet) have to be fetched.
+                channel = bot.bot_client.get_channel(message_event.channel_id) or await bot.bot_client.fetch_channel(message_event.channel_id)
+                message = await get_message(channel, message_event.message_id)
+            if message is None:
+                return
+            names = [reaction_name(reaction.emoji) for reaction in message.reactions]
+            users = await asyncio.gather(*[get_reaction_users(message, reaction, name) for reaction, name in zip(message.reactions, names)])
+        except (discord.HTTPException, discord.InvalidData) as e:
+            # HTTPException covers Forbidden and NotFound, e.g. a channel or message we can't see (any more).
+            logging.error(f"Error resolving reactions of message {message_event.message_id}: {e}")
+            return
+        message_event.reactions = [
+            ReactionEvent(reaction=name, user_id=user_id, message_id=message.id, channel_id=message.channel.id)
+            for name, user_ids in zip(names, users) for user_id in user_ids
+        ]
 
-    return messages
+    await asyncio.gather(*[resolve(message_event) for message_event in message_events])
 
 discord_bot_function_handler = ProviderFunctionsBase()
 
 discord_bot_function_handler.send_message = send_message
+discord_bot_function_handler.update_message = update_message
 discord_bot_function_handler.add_reaction = add_reaction
 discord_bot_function_handler.remove_reaction = remove_reaction
 discord_bot_function_handler.get_user_info = get_user_info
@@ -225,6 +359,10 @@ discord_bot_function_handler.get_message_info = get_message_info
 discord_bot_function_handler.get_messages_from_channel = get_messages_from_channel
 discord_bot_function_handler.get_messages_from_thread = get_messages_from_thread
 discord_bot_function_handler.get_previous_messages = get_previous_messages
+if RESOLVE_REACTION_USERS:
+    discord_bot_function_handler.resolve_reaction_users = resolve_reaction_users
+if OutboundQueue.OUTBOUND_QUEUE:
+    discord_bot_function_handler.outbound_queue = OutboundQueue.OutboundQueue("discord", {}, channel_limits=DISCORD_CHANNEL_RATE_LIMITS, global_limit=DISCORD_GLOBAL_RATE_LIMIT, get_retry_after=discord_retry_after)
 
 # -- Internal Helpers --
 def _get_bot_info(client):
@@ -245,6 +383,7 @@ def _get_bot_info(client):
 class DiscordHandler(discord.Client):
 
     async def on_message(self, message):
+        cache_message(message)
         # Don't respond to ourselves
         if message.author == self.user:
             return
@@ -253,8 +392,25 @@ class DiscordHandler(discord.Client):
         message_info = await convert_discord_message_to_message_event(bot_info, message)
         asyncio.create_task(event_handler(bot_info, "message", message_info))
 
+    # Keep the message cache in line with edits, deletions and reactions (cached messages carry their reactions).
+    async def on_raw_message_edit(self, payload):
+        MESSAGE_CACHE.pop(payload.message_id, None)
+
+    async def on_raw_message_delete(self, payload):
+        MESSAGE_CACHE.pop(payload.message_id, None)
+
+    async def on_raw_reaction_remove(self, payload):
+        MESSAGE_CACHE.pop(payload.message_id, None)
+
+    async def on_raw_reaction_clear(self, payload):
+        MESSAGE_CACHE.pop(payload.message_id, None)
+
+    async def on_raw_reaction_clear_emoji(self, payload):
+        MESSAGE_CACHE.pop(payload.message_id, None)
+
     # Note: We have to use 'raw' events to get reactions from messages not in our current running cache.
     async def on_raw_reaction_add(self, payload):   
+        MESSAGE_CACHE.pop(payload.message_id, None)
         if payload.user_id == self.user.id:
             return
         
@@ -0,0 +1,20 @@
+# CPU bound text extraction, run in the WorkerPool processes.
+# Workers import this module to unpickle the functions they run, so it only imports the libraries the extractors need.
+import io
+import PyPDF2
+import pytesseract
+from PIL import Image
+
+
+def extract_pdf_text(data):
+    pdfReader = PyPDF2.PdfFileReader(io.BytesIO(data))
+    # Get All Pages of Text and return
+    text = ""
+    for page in pdfReader.pages:
+        text += page.extractText()
+    return text
+
+
+def extract_image_text(data):
+    image = Image.open(io.BytesIO(data))
+    return pytesseract.image_to_string(image)
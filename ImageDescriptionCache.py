@@ -0,0 +1,22 @@
+# Management of the Image Description Cache
+# Descriptions produced by vision models are stored in SQLite, keyed by the image's content hash and the model that
+# described it. Writes are row-level, so the cost of a lookup or insert doesn't grow with the size of the cache.
+import os
+import BoundedCache
+import Telemetry
+
+IMAGE_DESC_CACHE_TTL = float(os.environ.get("IMAGE_DESC_CACHE_TTL", str(90 * 24 * 60 * 60)))
+IMAGE_DESC_CACHE_MAX_ENTRIES = int(os.environ.get("IMAGE_DESC_CACHE_MAX_ENTRIES", "500000"))
+
+_cache = BoundedCache.BoundedCache("img_desc_cache.db", "descriptions", ("content_hash", "model"), "description", IMAGE_DESC_CACHE_TTL, IMAGE_DESC_CACHE_MAX_ENTRIES)
+stats = _cache.stats
+Telemetry.register_cache("image_description", stats)
+
+
+def lookup_description(content_hash, model):
+    """ Returns the cached description of an image for the given vision model, or None. """
+    return _cache.lookup(content_hash, model)
+
+
+def add_description(content_hash, model, description):
+    _cache.add(content_hash, model, description)
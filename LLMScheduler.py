@@ -0,0 +1,157 @@
+# Scheduling of LLM requests.
+# Every call into LLMFoundation goes through a scheduler that bounds the number of requests in flight per model,
+# serves interactive requests before enrichment and background work, and rejects work when a queue is full.
+import os
+import heapq
+import asyncio
+import itertools
+import contextlib
+import weakref
+
+import Telemetry
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_ENRICHMENT = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_ENRICHMENT: "enrichment",
+    PRIORITY_BACKGROUND: "background",
+}
+
+# Maximum number of requests in flight per model.
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "2"))
+# Maximum number of requests waiting per model and priority class. Requests beyond this are rejected.
+LLM_QUEUE_LIMITS = {
+    PRIORITY_INTERACTIVE: int(os.environ.get("LLM_QUEUE_LIMIT_INTERACTIVE", "32")),
+    PRIORITY_ENRICHMENT: int(os.environ.get("LLM_QUEUE_LIMIT_ENRICHMENT", "64")),
+    PRIORITY_BACKGROUND: int(os.environ.get("LLM_QUEUE_LIMIT_BACKGROUND", "16")),
+}
+
+
+class SchedulerOverloaded(Exception):
+    """ Raised when a model's queue for the requested priority class is full. """
+
+
+class _Job:
+    def __init__(self, priority, future, run=None):
+        self.priority = priority
+        self.future = future
+        self.run = run
+
+
+class _ModelQueue:
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.heap = []
+        self.active = 0
+        self.depth = {priority: 0 for priority in PRIORITY_NAMES}
+
+
+class LLMScheduler:
+    def __init__(self):
+        self.queues = {}
+        self.counter = itertools.count()
+        self.stats = {'submitted': 0, 'rejected': 0}
+
+    def set_model_concurrency(self, model, max_concurrency):
+        self._queue(model).max_concurrency = max_concurrency
+
+    def queue_depths(self):
+        """ Returns {model: {priority name: waiting requests}} plus the number of requests in flight per model. """
+        return {model: dict({PRIORITY_NAMES[p]: depth for p, depth in queue.depth.items()}, active=queue.active) for model, queue in self.queues.items()}
+
+    def _queue(self, model):
+        if model not in self.queues:
+            self.queues[model] = _ModelQueue(LLM_MAX_CONCURRENCY)
+        return self.queues[model]
+
+    def _enqueue(self, model, job):
+        queue = self._queue(model)
+        if queue.depth[job.priority] >= LLM_QUEUE_LIMITS[job.priority]:
+            self.stats['rejected'] += 1
+            raise SchedulerOverloaded(f"{PRIORITY_NAMES[job.priority]} queue for {model} is full")
+        self.stats['submitted'] += 1
+        queue.depth[job.priority] += 1
+        heapq.heappush(queue.heap, (job.priority, next(self.counter), job))
+        self._dispatch(model)
+
+    async def submit(self, model, priority, run):
+        """ Runs run, a coroutine function taking no arguments, when the model has capacity and returns its result. """
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(model, _Job(priority, future, run))
+        return await future
+
+    @contextlib.asynccontextmanager
+    async def slot(self, model, priority):
+        """ Holds one of the model's slots for the duration of the block, e.g. while a response is streamed. """
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(model, _Job(priority, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been granted just as we were cancelled.
+            if future.done() and not future.cancelled():
+                self._release(model)
+            raise
+        try:
+            yield
+        finally:
+            self._release(model)
+
+    def _dispatch(self, model):
+        queue = self._queue(model)
+        while queue.active < queue.max_concurrency and queue.heap:
+            _, _, job = heapq.heappop(queue.heap)
+            queue.depth[job.priority] -= 1
+            # The caller gave up while the job was waiting.
+            if job.future.done():
+                continue
+            queue.active += 1
+            if job.run is None:
+                job.future.set_result(None)
+            else:
+                asyncio.create_task(self._run(model, job))
+
+    async def _run(self, model, job):
+        try:
+            result = await job.run()
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._release(model)
+
+    def _release(self, model):
+        self._queue(model).active -= 1
+        self._dispatch(model)
+
+
+# asyncio futures belong to one event loop, so each loop gets its own scheduler.
+_schedulers = weakref.WeakKeyDictionary()
+
+
+def get_scheduler() -> LLMScheduler:
+    loop = asyncio.get_running_loop()
+    if loop not in _schedulers:
+        _schedulers[loop] = LLMScheduler()
+    return _schedulers[loop]
+
+
+def _collect_metrics():
+    samples = []
+    for scheduler in list(_schedulers.values()):
+        for model, depths in scheduler.queue_depths().items():
+            active = depths.pop('active')
+            samples.append(("llm_requests_active", "gauge", {'model': model}, active))
+            samples.extend(("llm_queue_depth", "gauge", {'model': model, 'priority': priority}, depth) for priority, depth in depths.items())
+        samples.extend((f"llm_scheduler_{counter}_total", "counter", {}, value) for counter, value in scheduler.stats.items())
+    return samples
+
+Telemetry.register_collector(_collect_metrics)
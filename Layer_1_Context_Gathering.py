@@ -1,61 +1,74 @@
 # Logic surrounding the initial phase of the AI workflow. This phase is responsible for gathering context about the event that triggered the AI workflow.
-import PyPDF2
-import aiohttp
-import pytesseract
-from BotData import UserInfo, MessageEvent, ReactionEvent
-from PIL import Image
+import asyncio
+from BotData import UserInfo, MessageEvent
 import re
-import io
 import logging
 from datetime import datetime
 import os
+import SessionPool
+import WorkerPool
+import Extractors
+import BlobCache
+import ConversationState
+import StatusIndicator
+import Telemetry
+
+# Maximum number of attachments downloaded at the same time for a single request.
+ATTACHMENT_FETCH_CONCURRENCY = int(os.environ.get("ATTACHMENT_FETCH_CONCURRENCY", "8"))
+
+async def fetch_file_data(url_path, platform='discord'):
+    session = SessionPool.get_session(platform)
+    with Telemetry.span("download", platform):
+        async with session.get(url_path) as response:
+            response.raise_for_status()
+            return await response.read()
+
+async def get_file_data(file, platform='discord'):
+    # Files in a thread never change, so serve repeat downloads from the blob cache.
+    with Telemetry.span("cache", "blob"):
+        cached = await asyncio.to_thread(BlobCache.get_blob_for_url, file.url)
+    if cached is not None:
+        file.content_hash, data = cached
+        return data
+    data = await fetch_file_data(file.url, platform)
+    file.content_hash = await asyncio.to_thread(BlobCache.put_blob, file.url, data)
+    return data
+
+async def get_derived_text(file, kind, extractor, data):
+    with Telemetry.span("cache", "blob_text"):
+        text = await asyncio.to_thread(BlobCache.get_text, file.content_hash, kind)
+    if text is not None:
+        return text
+    try:
+        with Telemetry.span("extract", kind):
+            text = await WorkerPool.run_cpu_task(extractor, data)
+    except Exception as e:
+        logging.error(f"Error extracting {kind} from {file.url}: {e}")
+        return ""
+    await asyncio.to_thread(BlobCache.put_text, file.content_hash, kind, text)
+    return text
+
+
+async def process_file(file, platform, semaphore):
+    async with semaphore:
+        if "pdf" in file.file_type:
+            data = await get_file_data(file, platform)
+            file.file_data = await get_derived_text(file, "pdf_text", Extractors.extract_pdf_text, data)
+        elif "text" in file.file_type:
+            data = await get_file_data(file, platform)
+            file.file_data = data.decode('utf-8')
+        elif "image" in file.file_type:
+            file_data = await get_file_data(file, platform)
+            # Get OCR Data for Images
+            file.ocr_text = await get_derived_text(file, "ocr_text", Extractors.extract_image_text, file_data)
+            file.file_data = file_data
+
+
+async def process_files(files, platform):
+    # Download and process every attachment concurrently, bounded by ATTACHMENT_FETCH_CONCURRENCY.
+    semaphore = asyncio.Semaphore(ATTACHMENT_FETCH_CONCURRENCY)
+    await asyncio.gather(*[process_file(file, platform, semaphore) for file in files])
 
-async def get_pdf_text(url_path, platform='discord'):
-    async with aiohttp.ClientSession() as session:
-        if platform == 'slack':
-            async with session.get(url_path, headers={"Authorization": f"Bearer {os.environ.get('SLACK_BOT_TOKEN')}"}) as response:
-                f = await response.read()
-                pdfReader = PyPDF2.PdfFileReader(f)
-                # Get All Pages of Text and return
-                text = ""
-                for page in pdfReader.pages:
-                    text += page.extractText()
-                return text
-        else:
-            async with session.get(url_path) as response:
-                f = await response.read()
-                pdfReader = PyPDF2.PdfFileReader(f)
-                # Get All Pages of Text and return
-                text = ""
-                for page in pdfReader.pages:
-                    text += page.extractText()
-                return text
-                        
-
-async def get_txt_text(url_path, platform='discord'):
-    async with aiohttp.ClientSession() as session:
-        if platform == 'slack':
-            async with session.get(url_path, headers={"Authorization": f"Bearer {os.environ.get('SLACK_BOT_TOKEN')}"}) as response:
-                response.raise_for_status()
-                data = await response.read()
-                return data.decode('utf-8')  
-        else:
-            async with session.get(url_path) as response:
-                response.raise_for_status()
-                data = await response.read()
-                return data.decode('utf-8')  
-        
-async def get_image_data(url_path, platform='discord'):
-    async with aiohttp.ClientSession() as session:
-        if platform == 'slack':
-            async with session.get(url_path, headers={"Authorization": f"Bearer {os.environ.get('SLACK_BOT_TOKEN')}"}) as response:
-                response.raise_for_status()
-                return await response.read()
-        else:
-            async with session.get(url_path) as response:
-                response.raise_for_status()
-                return await response.read()            
-            
 
 
 
@@ -75,12 +88,13 @@ async def analyze_mentions(bot_info: UserInfo, author_id, message_event: Message
 
 async def process_layer(bot_info: UserInfo, message_event: MessageEvent):
     logging.info("----AI Phase 1: Context Gathering----")
-    new_reaction = ReactionEvent(reaction="phase_context_gathering",message_id=message_event.message_id,channel_id=message_event.channel_id,user_id=bot_info.id,message_owner_id=message_event.user_id)
-    await bot_info.bot_functions.call_add_reaction(bot_info, new_reaction)
+    StatusIndicator.set_phase(bot_info, message_event, "phase_context_gathering")
 
     event_context = {
         'previous_messages': [],
+        'new_messages': [],
         'message_transcript': [],
+        'conversation_summary': None,
         'author_info': None,
         'thread_participants': {},
         'mentioned_participants': {},
@@ -90,13 +104,24 @@ async def process_layer(bot_info: UserInfo, message_event: MessageEvent):
     # Get the info of the author of the message
     event_context['author_info'] = await bot_info.bot_functions.call_get_user_info(bot_info, message_event.user_id)
 
+    # Messages we've already seen in this conversation come from its thread state; only the others are processed.
+    thread_state = ConversationState.get_thread_state(bot_info.platform, message_event)
+    event_context['thread_state'] = thread_state
+
     # If the message was part of a continued conversation, we need to get the previous messages in the thread.
     # We also need to get the info of each user from those previous messages.
     if message_event.continued_conversation:
-        event_context['previous_messages'] = await bot_info.bot_functions.call_get_previous_messages(bot_info, message_event.channel_id, message_event.message_id, message_event.thread_id)
+        # Discord conversations are reply chains: if we know the message being replied to, we know all of its ancestors.
+        reply_chain = bot_info.platform == "discord"
+        if not reply_chain or message_event.parent_message_id not in thread_state:
+            # Slack threads are served from a cached snapshot, so fetching the whole thread is cheap; messages we
+            # already have are skipped by id.
+            fetched_messages = await bot_info.bot_functions.call_get_previous_messages(bot_info, message_event.channel_id, message_event.message_id, message_event.thread_id)
+            event_context['new_messages'] = thread_state.add_fetched_messages(fetched_messages, exclude_id=message_event.message_id)
+        event_context['previous_messages'] = thread_state.history(message_event, reply_chain=reply_chain)
         # If we have previous messages, we also need to get the info of each user from those previous messages.
         # We don't want the bot info or the user info of the message we are responding to.
-        if len(message_event.thread_participant_ids):
+        if message_event.thread_participant_ids:
             for tpid in message_event.thread_participant_ids:
                 if tpid != bot_info.id and tpid != message_event.user_id:
                     event_context['thread_participants'][tpid] = await bot_info.bot_functions.call_get_user_info(bot_info, tpid)
@@ -105,32 +130,10 @@ async def process_layer(bot_info: UserInfo, message_event: MessageEvent):
     # Regex to find mentions: <@USERID>                              
     event_context['mentioned_participants'] = await analyze_mentions(bot_info, message_event.user_id, message_event, event_context['mentioned_participants'])
 
-    for j in range(0, len(event_context['previous_messages'])):
-        message = event_context['previous_messages'][j]
-        for i in range(0, len(message.files)):
-            if "pdf" in message.files[i].file_type:
-                message.files[i].file_data = await get_pdf_text(message.files[i].url, bot_info.platform)
-            elif "text" in message.files[i].file_type:
-                message.files[i].file_data = await get_txt_text(message.files[i].url, bot_info.platform)
-            elif "image" in message.files[i].file_type:
-                file_data = await get_image_data(message.files[i].url, bot_info.platform)
-                # Get OCR Data for Images
-                message.files[i].ocr_text = pytesseract.image_to_string(Image.open(file_data))
-                message.files[i].file_data = file_data
-
-    # Get File and Image Data for Current Message
-    for file in message_event.files:
-        if "pdf" in file.file_type:
-            file.file_data = await get_pdf_text(file.url, bot_info.platform)
-        elif "text" in file.file_type:
-            file.file_data = await get_txt_text(file.url, bot_info.platform)
-        elif "image" in file.file_type:
-            file_data = await get_image_data(file.url, bot_info.platform)
-            # Get OCR Data for Images
-            image = Image.open(io.BytesIO(file_data))
-            file.ocr_text = pytesseract.image_to_string(image)
-            file.file_data = file_data
+    # Get File and Image Data for the New Previous Messages and the Current Message
+    files = [file for message in event_context['new_messages'] for file in message.files]
+    files.extend(message_event.files)
+    await process_files(files, bot_info.platform)
 
 
-    await bot_info.bot_functions.call_remove_reaction(bot_info, new_reaction)
     return event_context
\ No newline at end of file
@@ -1,112 +1,192 @@
 import os
-import json
+import time
+import asyncio
 import logging
-from BotData import UserInfo, MessageEvent, ReactionEvent, Message
+import hashlib
+import threading
+from BotData import UserInfo, MessageEvent, Message
 logging.basicConfig(level=logging.DEBUG)
 import LocalData
 import base64
+import ImageDescriptionCache
 import LLMFoundation
+import LLMScheduler
+import StatusIndicator
+import ConversationSummary
+import Telemetry
 from VectorLexicon import VectorLexicon
 
-IMG_DESC_CACHE_PATH = os.path.join(LocalData.CACHE_PATH, "img_desc_cache.json")
+LEXICON_PATH = os.environ.get("LEXICON_PATH", os.path.join(LocalData.BASE_PATH, "lexicon.vlex"))
+LEXICON_RELOAD_INTERVAL = float(os.environ.get("LEXICON_RELOAD_INTERVAL", "30"))
+# Maximum number of files described or summarized at the same time for a single request.
+ENRICHMENT_CONCURRENCY = int(os.environ.get("ENRICHMENT_CONCURRENCY", "4"))
 
 
-def load_img_desc_cache():
-    if os.path.exists(IMG_DESC_CACHE_PATH):
-        with open(IMG_DESC_CACHE_PATH, "r") as f:
-            return json.load(f)
-    else:
-        return {}
-
-def save_img_desc_cache(cache):
-    with open(IMG_DESC_CACHE_PATH, "w") as f:
-        json.dump(cache, f)
-
-# This holds the image description cache of image urls that have been processed by a vision AI
-IMAGE_DESC_CACHE = load_img_desc_cache()
+def _lexicon_file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def load_lexicon(path):
+    lexicon = VectorLexicon(path if os.path.exists(path) else None)
+    # Build the matcher and vector index before the lexicon is shared, so requests never see a half-built one.
+    lexicon.get_matcher()
+    lexicon.build_index()
+    return lexicon
+
+def _watch_lexicon():
+    # Reload the lexicon in the background whenever its file changes.
+    # The new lexicon is fully built before it's swapped in with a single assignment, so in-flight requests keep using
+    # the instance they already hold and are never blocked.
+    global LEXICON, LEXICON_SIGNATURE
+    while True:
+        time.sleep(LEXICON_RELOAD_INTERVAL)
+        signature = _lexicon_file_signature(LEXICON_PATH)
+        if signature == LEXICON_SIGNATURE:
+            continue
+        try:
+            lexicon = load_lexicon(LEXICON_PATH)
+        except Exception as e:
+            # Most likely the file is still being written; try again on the next pass.
+            logging.error(f"Error reloading lexicon from {LEXICON_PATH}: {e}")
+            continue
+        LEXICON, LEXICON_SIGNATURE = lexicon, signature
+        logging.info(f"Reloaded lexicon from {LEXICON_PATH}")
+
+def get_lexicon() -> VectorLexicon:
+    return LEXICON
+
+# This holds the process-wide lexicon, loaded once at startup and replaced whenever LEXICON_PATH changes.
+LEXICON_SIGNATURE = _lexicon_file_signature(LEXICON_PATH)
+try:
+    LEXICON = load_lexicon(LEXICON_PATH)
+except Exception as e:
+    logging.error(f"Error loading lexicon from {LEXICON_PATH}: {e}")
+    LEXICON = VectorLexicon()
+threading.Thread(target=_watch_lexicon, daemon=True).start()
 
 async def process_images_for_vision(bot_info, file):
     """Asynchronously process image files in the message and prepare data for LLaVA."""
+    content_hash = file.content_hash or hashlib.sha256(file.file_data).hexdigest()
+    model = LLMFoundation.vision_backend.model
 
-    # Check the URL against the image description cache
-    if file.url in IMAGE_DESC_CACHE:
-        # If the URL is in the cache, use the cached description
-        return IMAGE_DESC_CACHE[file.url]['description']
-    
-    else:
-        # Asynchronously encode the image to base64
-        encoded_image = base64.b64encode(file.file_data).decode('utf-8')
+    # Check the image against the image description cache
+    with Telemetry.span("cache", "image_description"):
+        summary = await asyncio.to_thread(ImageDescriptionCache.lookup_description, content_hash, model)
+    if summary is not None:
+        return summary
 
-        #file.description = await describe_image_gpt4v(encoded_image)
-        summary = await LLMFoundation.describe_image_llava(encoded_image)         
+    # Asynchronously encode the image to base64
+    encoded_image = base64.b64encode(file.file_data).decode('utf-8')
 
+    #file.description = await describe_image_gpt4v(encoded_image)
+    try:
+        summary = await LLMFoundation.describe_image_llava(encoded_image, priority=LLMFoundation.PRIORITY_ENRICHMENT)
+    except LLMScheduler.SchedulerOverloaded as e:
+        # Under overload we answer without the description rather than not at all.
+        logging.warning(f"Skipping image description: {e}")
+        return ""
 
-        # Add the image description to the cache
-        IMAGE_DESC_CACHE[file.url] = summary
-        # Save the cache
-        save_img_desc_cache(IMAGE_DESC_CACHE)
-        return summary
+    # Add the image description to the cache
+    await asyncio.to_thread(ImageDescriptionCache.add_description, content_hash, model, summary)
+    return summary
 
 
-async def create_message_transcript(previous_messages:list[MessageEvent]) -> str:
-    transcript = "Below is the transcript of the conversation leading up to this message. If relevant, use this to help understand the context of the current request:\n\n ```\n"
-    for previous_message in previous_messages:
-        transcript += f"{previous_message.user_id}: {previous_message.text}\n"
-        if previous_message.files:
-            for file in previous_message.files:
-                if 'image' in file.file_type:
-                    transcript += f"*** Image Attached containing text: {file.ocr_text} and described as: {file.summary} ***\n"
-                elif 'pdf' in file.file_type or 'text' in file.file_type:
-                    transcript += f"*** Document Attached summarized as: {file.summary} ***\n"
-      
-        reactions = previous_message.reactions
-        if len(reactions) > 0:
-            for reaction in reactions:
-                transcript += f"*User ID {reaction.user_id} reacted to this message with: {reaction.reaction}*\n"
-            
-    transcript += "\n```\n\n"
-    return transcript
+def render_transcript_lines(previous_message: MessageEvent) -> str:
+    lines = f"{previous_message.user_id}: {previous_message.text}\n"
+    if previous_message.files:
+        for file in previous_message.files:
+            if 'image' in file.file_type:
+                lines += f"*** Image Attached containing text: {file.ocr_text} and described as: {file.summary} ***\n"
+            elif 'pdf' in file.file_type or 'text' in file.file_type:
+                lines += f"*** Document Attached summarized as: {file.summary} ***\n"
+
+    reactions = previous_message.reactions
+    if len(reactions) > 0:
+        for reaction in reactions:
+            if reaction.user_id is None:
+                lines += f"*{reaction.count} user(s) reacted to this message with: {reaction.reaction}*\n"
+            else:
+                lines += f"*User ID {reaction.user_id} reacted to this message with: {reaction.reaction}*\n"
+    return lines
+
+TRANSCRIPT_HEADER = "Below is the transcript of the conversation leading up to this message. If relevant, use this to help understand the context of the current request:\n\n ```\n"
+TRANSCRIPT_FOOTER = "\n```\n\n"
 
 async def get_summary_of_text_files(bot_info, file):
     """Asynchronously process text files in the message and prepare data for inferece."""
-    return await LLMFoundation.text_ask_local_llm(f"Summarize the Following Document: \n\n {file.file_data}")
+    try:
+        return await LLMFoundation.text_ask_local_llm(f"Summarize the Following Document: \n\n {file.file_data}", temperature=0, priority=LLMFoundation.PRIORITY_ENRICHMENT)
+    except LLMScheduler.SchedulerOverloaded as e:
+        logging.warning(f"Skipping document summary: {e}")
+        return ""
+
+
+def _get_enricher(file):
+    if 'image' in file.file_type:
+        return process_images_for_vision
+    elif "pdf" in file.file_type or "text" in file.file_type:
+        return get_summary_of_text_files
+    return None
+
+async def enrich_file(bot_info, file, enricher, semaphore):
+    async with semaphore:
+        return await enricher(bot_info, file)
+
+async def enrich_files(bot_info, files):
+    # Enrich every file concurrently, bounded by ENRICHMENT_CONCURRENCY.
+    # A file reposted in the thread shows up once per message, so files are grouped by content (or URL if the
+    # content hash is unknown) and each group costs a single model call.
+    semaphore = asyncio.Semaphore(ENRICHMENT_CONCURRENCY)
+    groups = {}
+    for file in files:
+        enricher = _get_enricher(file)
+        # Files that couldn't be fetched have nothing to enrich.
+        if enricher is None or not file.file_data:
+            continue
+        key = (enricher, file.content_hash or file.url or id(file))
+        groups.setdefault(key, []).append(file)
+    summaries = await asyncio.gather(*[enrich_file(bot_info, group[0], enricher, semaphore) for (enricher, _), group in groups.items()])
+    for group, summary in zip(groups.values(), summaries):
+        for file in group:
+            file.summary = summary
 
 
 async def process_layer(bot_info: UserInfo, message_event: MessageEvent, event_context):
     logging.info("----AI Phase 2: Enrichment----")
-    new_reaction = ReactionEvent(reaction="phase_enrichment",message_id=message_event.message_id,channel_id=message_event.channel_id,user_id=bot_info.id,message_owner_id=message_event.user_id)
-    await bot_info.bot_functions.call_add_reaction(bot_info, new_reaction)
-
-    # Image Enrichment
-    for file in message_event.files:
-        if 'image' in file.file_type:
-            file.summary = await process_images_for_vision(bot_info, file)
-        elif "pdf" in file.file_type or "text" in file.file_type:
-            file.summary = await get_summary_of_text_files(bot_info, file)
-
-    for message in event_context['previous_messages']:
-        for file in message.files:
-            if 'image' in file.file_type:
-                file.summary = await process_images_for_vision(bot_info, file)
-            elif "pdf" in file.file_type or "text" in file.file_type:
-                file.summary = await get_summary_of_text_files(bot_info, file)
+    StatusIndicator.set_phase(bot_info, message_event, "phase_enrichment")
+
+    # File Enrichment for the Current Message and the Previous Messages we haven't seen before
+    files = list(message_event.files)
+    files.extend(file for message in event_context['new_messages'] for file in message.files)
+    await enrich_files(bot_info, files)
+
+    # The current message is now fully processed, so later turns in this conversation can reuse it.
+    thread_state = event_context['thread_state']
+    thread_state.add_message(message_event)
+    thread_state.release_file_data(event_context['new_messages'] + [message_event])
 
     # Invote Lexicon Enrichment
-    # TODO: Add Cached Lexicon
-    vectordb = VectorLexicon()
+    vectordb = get_lexicon()
     try:
         event_context['lexicon_enrichment'] = vectordb.enrich_prompt(message_event.text, user_clarification=False)
     except Exception as e:
         logging.error(f"Error enriching prompt: {e}")
         event_context['lexicon_enrichment'] = []
 
-    if event_context['previous_messages']:
-        event_context['conversation_transcript'] = create_message_transcript(event_context['previous_messages'])
+    # Transcript lines of messages from earlier turns are rendered once and kept in the thread state.
+    # Reactions are only reported as counts; where the provider supports it, find out who reacted before rendering.
+    # In summary mode, older turns are covered by the thread's running summary and only the recent ones are rendered.
+    event_context['conversation_summary'], recent_messages = await ConversationSummary.split_history(thread_state, event_context['previous_messages'])
+    unrendered = [message for message in recent_messages if message.message_id not in thread_state.transcript_lines]
+    await bot_info.bot_functions.call_resolve_reaction_users(bot_info, [message for message in unrendered if message.reactions])
+    event_context['message_transcript'] = [thread_state.get_transcript_lines(message, render_transcript_lines) for message in recent_messages]
     
 
     # Sentiment Analysis
     thought_prompt = f"Analyze the request: '{message_event.text}'. Reflect on the general intent and implications of this query. Do not answer the question; instead, focus on understanding and interpreting the request. After your analysis, prepare a response in a JSON format, where 'thought' captures your internal analysis process and 'explanation' is a restatement or clarification of the request as you understand it."
     event_context['sentiment_analysis'] = "Nevermind this" #await LLMFoundation.text_ask_local_llm(thought_prompt, temperature=0.5)
 
-    await bot_info.bot_functions.call_remove_reaction(bot_info, new_reaction)
     return event_context
\ No newline at end of file
@@ -1,48 +1,57 @@
 # This layer controls the actual processing plan. It is responsible for determining the plan for the bot to respond to the user's request by engaging variopus workflows and agents to complete the request.
+import os
 import logging
 
-from BotData import UserInfo, MessageEvent, ReactionEvent, Message
+from BotData import UserInfo, MessageEvent, Message
 
 import LLMFoundation
+import Layer_2_Enrichment
+import PromptBuilder
+import LLMScheduler
+import StatusIndicator
 
 logging.basicConfig(level=logging.INFO)
 
+# When enabled, the response is streamed into the chat as it's generated instead of being posted once it's complete.
+STREAM_RESPONSES = os.environ.get("STREAM_RESPONSES", "false").lower() in ("1", "true", "yes")
 
 
 
 async def process_layer(bot_info: UserInfo, message_event: MessageEvent, event_context):
     processing_result = None
     logging.info("----AI Phase 3: Processing----")
-    new_reaction = ReactionEvent(reaction="phase_processing",message_id=message_event.message_id,channel_id=message_event.channel_id,user_id=bot_info.id,message_owner_id=message_event.user_id)
-    await bot_info.bot_functions.call_add_reaction(bot_info, new_reaction)
+    StatusIndicator.set_phase(bot_info, message_event, "phase_processing")
     # TODO ADD CODE
     #TODO Future - Break Down Problem into Sub-Problems and give to Dispatch AI to determine COA
     # For now, we will enrich the prompt and use the default llm.
-    prompt = "Current Date: " + event_context['current_date'] + "\n"    
-
-    prompt += f"You are a helpful AI Assistant named {bot_info.id}.  You are in a conversation with {message_event.user_id} and will answer their request to the best of your ability.\n"
+    # Sections are cut, least important first, to fit the model's prompt budget.
+    builder = PromptBuilder.PromptBuilder(LLMFoundation.text_backend.model)
+    builder.add("instructions", "Current Date: " + event_context['current_date'] + "\n" +
+                f"You are a helpful AI Assistant named {bot_info.id}.  You are in a conversation with {message_event.user_id} and will answer their request to the best of your ability.\n")
 
     # Only include user info to prompt if we have notes, audience, or bio
     if event_context['author_info'].notes or event_context['author_info'].audience or event_context['author_info'].bio:
-        prompt += f"``` Use their User Info to influence your responses \n User Info: \n{event_context['author_info']}\n```"
+        builder.add("author_info", f"``` Use their User Info to influence your responses \n User Info: \n{event_context['author_info']}\n```", PromptBuilder.PRIORITY_AUTHOR)
+
+    # Include the summary of the earlier conversation, if older turns have been summarized
+    if event_context.get('conversation_summary'):
+        builder.add("summary", event_context['conversation_summary'], PromptBuilder.PRIORITY_SUMMARY,
+                    header="Below is a summary of the earlier conversation:\n\n ```\n", footer="\n```\n\n")
 
     # Include Conversation history if needed
-    if event_context['previous_messages']:
-        prompt += event_context['conversation_transcript']
+    if event_context['message_transcript']:
+        builder.add_lines("transcript", event_context['message_transcript'], PromptBuilder.PRIORITY_TRANSCRIPT,
+                          header=Layer_2_Enrichment.TRANSCRIPT_HEADER, footer=Layer_2_Enrichment.TRANSCRIPT_FOOTER)
 
     # Include Thread Participants if needed
     if event_context['thread_participants']:
-        prompt += "``` Use the following Thread Participants to influence your responses: \n"
-        for participant in event_context['thread_participants']:
-            prompt += f"{participant}\n"
-        prompt += "```"
+        builder.add_lines("thread_participants", [f"{participant}\n" for participant in event_context['thread_participants']], PromptBuilder.PRIORITY_PARTICIPANTS,
+                          header="``` Use the following Thread Participants to influence your responses: \n", footer="```")
 
     # Include Mentioned Participants if needed
     if event_context['mentioned_participants']:
-        prompt += "``` Use the following Mentioned Participants to influence your responses: \n"
-        for participant_id in event_context['mentioned_participants']:
-            prompt += f"\n\n{event_context['mentioned_participants'][participant_id]}\n\n"
-        prompt += "```"
+        builder.add_lines("mentioned_participants", [f"\n\n{participant}\n\n" for participant in event_context['mentioned_participants'].values()], PromptBuilder.PRIORITY_MENTIONED,
+                          header="``` Use the following Mentioned Participants to influence your responses: \n", footer="```")
 
     # Include Lexicon Enrichment if needed
     """
@@ -55,24 +64,36 @@ async def process_layer(bot_info: UserInfo, message_event: MessageEvent, event_c
 
     # Include any file Summaries
     if message_event.files:
+        file_summaries = ""
         for file in message_event.files:
             if 'image' in file.file_type:
-                prompt += f"*** Image Attached containing text: {file.ocr_text} and described as: {file.summary} ***\n"
+                file_summaries += f"*** Image Attached containing text: {file.ocr_text} and described as: {file.summary} ***\n"
             elif 'pdf' in file.file_type or 'text' in file.file_type:
-                prompt += f"*** Document Attached summarized as: {file.summary} ***\n"    
+                file_summaries += f"*** Document Attached summarized as: {file.summary} ***\n"
+        builder.add("files", file_summaries, PromptBuilder.PRIORITY_FILES)
 
     # Remove the bot's name from the prompt
     message_event.text = message_event.text.replace(f"<@{bot_info.id}>", "").replace(f"<@!{bot_info.id}>", "")
     # Finally, Include the Actual Request
-    prompt += f"``` Request: \n{message_event.text}\n```"
+    builder.add("request", f"``` Request: \n{message_event.text}\n```")
+
+    prompt = builder.build()
+    logging.info(f"Prompt tokens: {builder.total_tokens()}/{builder.budget} {builder.report()}")
 
     logging.info("----------------------")
     logging.info("Prompt: " + prompt)
     logging.info("----------------------")
 
     # Send the Prompt to the LLM
-    response = await LLMFoundation.text_ask_local_llm(prompt)
-    processing_result = {'result':'OK', 'response':response}
+    if STREAM_RESPONSES and bot_info.bot_functions.update_message is not None:
+        # Generation starts when Layer 4 begins consuming the stream.
+        processing_result = {'result':'OK', 'stream':LLMFoundation.stream_local_llm(prompt)}
+    else:
+        try:
+            response = await LLMFoundation.text_ask_local_llm(prompt)
+            processing_result = {'result':'OK', 'response':response}
+        except LLMScheduler.SchedulerOverloaded as e:
+            logging.error(f"Unable to process request: {e}")
+            processing_result = {'result':'OVERLOADED', 'response':None}
 
-    await bot_info.bot_functions.call_remove_reaction(bot_info, new_reaction)
     return processing_result
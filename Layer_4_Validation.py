@@ -1,25 +1,26 @@
+import os
 import re
+import time
 import logging
 import json
 import asyncio
-from UserProfile import add_userinfo_to_cache
-from BotData import UserInfo, MessageEvent, ReactionEvent, Message
+from UserProfile import add_userinfo_to_cache, lookup_userinfo
+from BotData import UserInfo, MessageEvent, Message
 
-import threading
 import LLMFoundation
+import BackgroundJobs
+import StatusIndicator
+import ConversationSummary
+import Layer_2_Enrichment
 
 logging.basicConfig(level=logging.DEBUG)
 
 
-# In case we need a parallel event loop for stuff
-def start_loop(loop):
-    asyncio.set_event_loop(loop)
-    loop.run_forever()
-
-new_loop = asyncio.new_event_loop()
-t = threading.Thread(target=start_loop, args=(new_loop,))
-t.start()
-
+# Minimum time between two progressive updates of a streamed response, to stay within the providers' rate limits.
+STREAM_UPDATE_INTERVAL = float(os.environ.get("STREAM_UPDATE_INTERVAL", "1.0"))
+STREAM_PLACEHOLDER = "..."
+# Shown in place of (or after) the streamed text if generating the reply fails.
+STREAM_ERROR_MESSAGE = "(Sorry, something went wrong while writing this reply.)"
 
 
 async def fix_user_mentions(text, platform="slack"):
@@ -51,75 +52,185 @@ async def fix_user_mentions(text, platform="slack"):
 
     return fixed_text
 
-async def update_notes_thread(user_info, message, response):
+# User profile notes are updated in the background: a user's exchanges within NOTES_UPDATE_DEBOUNCE seconds are
+# handled together, and up to NOTES_UPDATE_BATCH users share one extraction prompt.
+NOTES_UPDATE_DEBOUNCE = float(os.environ.get("NOTES_UPDATE_DEBOUNCE", "60"))
+NOTES_UPDATE_BATCH = int(os.environ.get("NOTES_UPDATE_BATCH", "4"))
+NOTES_UPDATE_MAX_RETRIES = 3
+
+
+async def update_user_notes(batch):
+    """ batch maps user ids to lists of (user_info, request, response) exchanges. """
     notes_prompt = """
-    Based on the user's profile, user's request, and assistant response, provide any new and relevant personal characteristics, interests, and facts relevant to the user's personality profile.\n
-    Exclude notes about the conversation or interaction. If no update is necessary, respond with an empty JSON array '[]'.\n
+    Based on each user's profile, requests, and assistant responses, provide any new and relevant personal characteristics, interests, and facts relevant to the user's personality profile.\n
+    Exclude notes about the conversation or interaction. Respond with a JSON object mapping each user's ID to a JSON list of their new notes; use an empty list '[]' if no update is necessary.\n
     """
-    notes_prompt += f"User Info: \n{user_info}\n"
-    notes_prompt += f"Request: {message.user_id}: {message.text}\n"
-    notes_prompt += f"Assistant Response: {response}\n"
-    notes_prompt += f"Current Notes in JSON Format: {json.dumps(user_info.notes)}\n"
-    notes_prompt += "New Notes (in JSON List Format): "
+    users = {}
+    for user_id, exchanges in batch.items():
+        # The stored profile may have changed since the exchange; update the latest one.
+        user_info = await asyncio.to_thread(lookup_userinfo, user_id) or exchanges[-1][0]
+        users[user_id] = user_info
+        notes_prompt += f"\nUser ID: {user_id}\nUser Info: \n{user_info}\n"
+        notes_prompt += f"Current Notes in JSON Format: {json.dumps(user_info.notes)}\n"
+        for _, request, response in exchanges:
+            notes_prompt += f"Request: {request}\n"
+            notes_prompt += f"Assistant Response: {response}\n"
+    notes_prompt += "\nNew Notes (as a JSON object of user ID to JSON list): "
+
+    for retry_count in range(NOTES_UPDATE_MAX_RETRIES):
+        notes_response = await LLMFoundation.text_ask_local_llm(notes_prompt, temperature=0.5, output_json=True, priority=LLMFoundation.PRIORITY_BACKGROUND, use_cache=False)
+        logging.info(f"Notes Response: {notes_response}")
+        try:
+            if "```json" in notes_response:
+                notes_response = notes_response.replace("```json", "").replace("```", "")
+            new_notes = json.loads(notes_response)
+            if not isinstance(new_notes, dict):
+                raise ValueError("expected a JSON object")
+        except ValueError:
+            logging.warning(f"Retry {retry_count + 1}: Failed to decode JSON from the LLM response.")
+            continue
+        for user_id, user_info in users.items():
+            user_notes = new_notes.get(str(user_id), [])
+            if not isinstance(user_notes, list):
+                logging.warning(f"Ignoring notes for {user_id}: expected a JSON list, got {type(user_notes).__name__}")
+                continue
+            notes = [note for note in user_notes if isinstance(note, str) and note not in user_info.notes]
+            if notes:
+                user_info.notes.extend(notes)
+                await asyncio.to_thread(add_userinfo_to_cache, user_info)
+                logging.info(f"Updated User Info: {user_info}")
+        return
 
+    logging.error("Max retries reached, failed to obtain valid JSON response.")
 
-    max_retries = 3
-    retry_count = 0
 
-    while retry_count < max_retries:
-        notes_response = await LLMFoundation.text_ask_ai(notes_prompt, temperature=0.5)
-        logging.info(f"Notes Response: {notes_response}")
+notes_jobs = BackgroundJobs.BackgroundJobs("user notes", update_user_notes, NOTES_UPDATE_DEBOUNCE, batch_size=NOTES_UPDATE_BATCH)
 
-        if notes_response != '[]':
-            try:
-                if "```json" in notes_response:
-                    notes_response = notes_response.replace("```json", "").replace("```", "")
-                new_notes = json.loads(notes_response)
-                # Process and break if valid response
-                for note in new_notes:
-                    if note not in user_info.notes:
-                        user_info.notes.append(note)
-                add_userinfo_to_cache(user_info)
-                logging.info(f"Updated User Info: {user_info}")
-                break
-            except json.JSONDecodeError:
-                logging.warning(f"Retry {retry_count + 1}: Failed to decode JSON from the LLM response.")
 
-        retry_count += 1
+def strip_bot_name(bot_info: UserInfo, response):
+    # Remove the bot's name from the response
+    if response.startswith(f"{bot_info.id}:"):
+        response = response[len(f"{bot_info.id}:"):].strip()
+    return response
 
-    if retry_count == max_retries:
-        logging.error("Max retries reached, failed to obtain valid JSON response.")
+
+async def postprocess_response(bot_info: UserInfo, response):
+    response = strip_bot_name(bot_info, response)
+
+    # Fix user mentions in the response
+    return await fix_user_mentions(response, bot_info.platform)
+
+
+def split_message(text, chunk_size):
+    return [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
+
+
+async def stream_response(bot_info: UserInfo, message_event: MessageEvent, token_stream):
+    """ Posts a placeholder reply and progressively edits the generated text into it. Returns the final response and the ids of the messages it was sent as. """
+    functions = bot_info.bot_functions
+    sent_ids = []
+    sent_chunks = []
+
+    def new_message(text):
+        message = Message(text=text,platform=bot_info.platform)
+        message.thread_id = message_event.thread_id
+        message.parent_message_id = message_event.message_id
+        message.channel = message_event.channel_id
+        return message
+
+    async def publish(text):
+        # Edit the chunks that changed and send new messages for text past the provider's message length limit.
+        for i, chunk in enumerate(split_message(text, functions.max_message_length)):
+            if i < len(sent_ids):
+                if chunk != sent_chunks[i]:
+                    message = new_message(chunk)
+                    message.message_id = sent_ids[i]
+                    await functions.call_update_message(bot_info, message)
+                    sent_chunks[i] = chunk
+            else:
+                sent_ids.append(await functions.call_send_message(bot_info, new_message(chunk)))
+                sent_chunks.append(chunk)
+
+    start_time = time.monotonic()
+    raw_response = ""
+    shown = ""
+    last_update = None
+    # The placeholder is posted while the model starts generating, rather than holding up the request.
+    placeholder = asyncio.create_task(publish(STREAM_PLACEHOLDER))
+    try:
+        async for token in token_stream:
+            raw_response += token
+            now = time.monotonic()
+            # The first token is shown right away, after that updates are throttled.
+            if last_update is not None and now - last_update < STREAM_UPDATE_INTERVAL:
+                continue
+            # Mentions are only fixed in the final text; the progressive updates just drop the bot's name.
+            text = strip_bot_name(bot_info, raw_response)
+            if not text.strip():
+                continue
+            await placeholder
+            await publish(text)
+            shown = text
+            if last_update is None:
+                logging.info(f"Time to first visible token: {time.monotonic() - start_time:.2f}s")
+            last_update = now
+
+        await placeholder
+        response = await postprocess_response(bot_info, raw_response)
+        await publish(response if response.strip() else STREAM_PLACEHOLDER)
+    except Exception:
+        # Don't leave the placeholder (or a cut-off answer without explanation) as the reply.
+        await asyncio.gather(placeholder, return_exceptions=True)
+        if sent_ids:
+            try:
+                await publish(f"{shown}\n\n{STREAM_ERROR_MESSAGE}" if shown else STREAM_ERROR_MESSAGE)
+            except Exception as e:
+                logging.error(f"Error replacing the streamed reply: {e}")
+        raise
+    finally:
+        # Releases the model's scheduler slot and HTTP response right away, even if we stopped early.
+        await token_stream.aclose()
+    return response, sent_ids
 
 
 async def process_layer(bot_info: UserInfo, message_event: MessageEvent, event_context, processing_result):
     logging.info("----AI Phase 4: Validation----")
-    new_reaction = ReactionEvent(reaction="phase_validation",message_id=message_event.message_id,channel_id=message_event.channel_id,user_id=bot_info.id,message_owner_id=message_event.user_id)
-    await bot_info.bot_functions.call_add_reaction(bot_info, new_reaction)
+    StatusIndicator.set_phase(bot_info, message_event, "phase_validation")
     
     if processing_result['result'] != 'OK':
         logging.error("Processing Failed")
-        await bot_info.bot_functions.call_remove_reaction(bot_info, new_reaction)
         return False
-    
-    response = processing_result['response']
-    # Remove the bot's name from the response
-    if response.startswith(f"{bot_info.id}:"):
-        response = response[len(f"{bot_info.id}:"):].strip()
-
-    # Fix user mentions in the response
-    response = await fix_user_mentions(response, bot_info.platform)      
-    
-    # Update User Profile Notes if Necessary
-    asyncio.run_coroutine_threadsafe(update_notes_thread(event_context['author_info'],message_event, response), new_loop)
 
+    if 'stream' in processing_result:
+        # Stream the response into the chat as it's generated.
+        try:
+            response, sent_ids = await stream_response(bot_info, message_event, processing_result['stream'])
+        except Exception as e:
+            logging.error(f"Error streaming response: {e}")
+            return False
+    else:
+        response = await postprocess_response(bot_info, processing_result['response'])
+
+        # Send the Final Response Message to our user.
+        new_message = Message(text=response,platform=bot_info.platform)
+        new_message.thread_id = message_event.thread_id
+        new_message.parent_message_id = message_event.message_id
+        new_message.channel = message_event.channel_id
+        sent_ids = [await bot_info.bot_functions.call_send_message(bot_info, message=new_message)]
+
+    # Remember our reply so the next turn of the conversation doesn't have to fetch it.
+    if 'thread_state' in event_context:
+        thread_state = event_context['thread_state']
+        thread_state.add_reply(bot_info.id, message_event, response, sent_ids)
+        # Fold the older turns into the conversation's running summary in the background.
+        reply = thread_state.messages.get(sent_ids[0]) if sent_ids else None
+        conversation = event_context['previous_messages'] + [message_event] + ([reply] if reply is not None else [])
+        await ConversationSummary.schedule_update(thread_state, conversation, Layer_2_Enrichment.render_transcript_lines)
 
-    # Send the Final Response Message to our user.
-    new_message = Message(text=response,platform=bot_info.platform)
-    new_message.thread_id = message_event.thread_id
-    new_message.parent_message_id = message_event.message_id
-    new_message.channel = message_event.channel_id
-    await bot_info.bot_functions.call_send_message(bot_info, message=new_message)
+    # Update User Profile Notes if Necessary
+    author_info = event_context['author_info']
+    if author_info is not None:
+        notes_jobs.submit(str(author_info.id), (author_info, f"{message_event.user_id}: {message_event.text}", response))
 
-    await bot_info.bot_functions.call_remove_reaction(bot_info, new_reaction)
     # This will send the result and choose to either go to Phase 5 or Phase 6
     return True
\ No newline at end of file
@@ -0,0 +1,282 @@
+# Versioned, memory-mappable file format for VectorLexicon.
+#
+# Layout (little-endian):
+#   MAGIC (8 bytes) | version (uint32) | header length (uint32) | header JSON | padding to SECTION_ALIGNMENT
+#   followed by the sections listed in the header, each aligned to SECTION_ALIGNMENT.
+#
+# Strings are stored as a UTF-8 blob plus an int64 offsets array, lists are stored as int64 ranges into a flat table,
+# and the vector index is a raw float32 matrix. Terms and aliases also get an open-addressing hash table so they can be
+# looked up straight from the mapped file. Loading only parses the header, so it takes constant time, and since the
+# file is mapped read-only, bot processes that load the same file share its pages.
+import os
+import json
+import mmap
+import struct
+import hashlib
+import threading
+from collections.abc import Mapping, Sequence
+import numpy as np
+
+MAGIC = b"VLEXMMAP"
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct("<II")
+SECTION_ALIGNMENT = 64
+
+
+def is_lexicon_file(filepath):
+    with open(filepath, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _hash_key(key_bytes):
+    return int.from_bytes(hashlib.blake2b(key_bytes, digest_size=8).digest(), "little")
+
+
+# -- Writing --
+
+def _string_table(strings):
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(item) for item in encoded], dtype=np.int64)
+    return encoded, np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _ranges(lengths):
+    ranges = np.zeros(len(lengths) + 1, dtype=np.int64)
+    ranges[1:] = np.cumsum(lengths, dtype=np.int64)
+    return ranges
+
+
+def _hash_table(encoded_keys):
+    # Linear probing with at most a 50% load factor. Each slot holds the key's hash and its index (-1 if empty).
+    size = 8
+    while size < len(encoded_keys) * 2:
+        size *= 2
+    hashes = np.zeros(size, dtype=np.uint64)
+    slots = np.full(size, -1, dtype=np.int64)
+    mask = size - 1
+    for index, key in enumerate(encoded_keys):
+        key_hash = _hash_key(key)
+        slot = key_hash & mask
+        while slots[slot] >= 0:
+            slot = (slot + 1) & mask
+        hashes[slot] = key_hash
+        slots[slot] = index
+    return hashes, slots
+
+
+def write_lexicon(filepath, db, alias_terms, index, terms_index, n_features, max_key_segments):
+    """ Writes a lexicon to filepath. The file is replaced atomically, so processes that have it mapped are unaffected. """
+    terms = list(db)
+    term_numbers = {term: number for number, term in enumerate(terms)}
+    aliases = list(alias_terms)
+    encoded_terms, terms_blob, terms_offsets = _string_table(terms)
+    encoded_aliases, aliases_blob, aliases_offsets = _string_table(aliases)
+    term_hashes, term_slots = _hash_table(encoded_terms)
+    alias_hashes, alias_slots = _hash_table(encoded_aliases)
+
+    _, definitions_blob, definitions_offsets = _string_table([definition for term in terms for definition in db[term]['definitions']])
+    _, references_blob, references_offsets = _string_table([reference for term in terms for reference in db[term].get('references', [])])
+    _, alias_targets_blob, alias_targets_offsets = _string_table([target for alias in aliases for target in alias_terms[alias]])
+
+    if index is None:
+        index = np.zeros((0, n_features), dtype=np.float32)
+    sections = {
+        'terms_blob': terms_blob,
+        'terms_offsets': terms_offsets,
+        'term_hashes': term_hashes,
+        'term_slots': term_slots,
+        'definitions_blob': definitions_blob,
+        'definitions_offsets': definitions_offsets,
+        'term_definitions': _ranges([len(db[term]['definitions']) for term in terms]),
+        'references_blob': references_blob,
+        'references_offsets': references_offsets,
+        'term_references': _ranges([len(db[term].get('references', [])) for term in terms]),
+        'aliases_blob': aliases_blob,
+        'aliases_offsets': aliases_offsets,
+        'alias_hashes': alias_hashes,
+        'alias_slots': alias_slots,
+        'alias_targets_blob': alias_targets_blob,
+        'alias_targets_offsets': alias_targets_offsets,
+        'alias_targets': _ranges([len(alias_terms[alias]) for alias in aliases]),
+        'vectors': np.ascontiguousarray(index, dtype=np.float32),
+        'row_terms': np.array([term_numbers[term] for term, _ in terms_index], dtype=np.int64),
+        'row_definitions': np.array([number for _, number in terms_index], dtype=np.int64),
+    }
+
+    # Section offsets are relative to the start of the data, so the header size doesn't depend on them.
+    layout = {}
+    offset = 0
+    for name, array in sections.items():
+        offset = -(-offset // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+        layout[name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        offset += array.nbytes
+    header = json.dumps({
+        'n_features': n_features,
+        'max_key_segments': max_key_segments,
+        'sections': layout,
+    }).encode("utf-8")
+
+    temp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(PREAMBLE.pack(FORMAT_VERSION, len(header)))
+        f.write(header)
+        data_start = -(-f.tell() // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+        for name, array in sections.items():
+            f.write(b"\0" * (data_start + layout[name]['offset'] - f.tell()))
+            f.write(array.tobytes())
+    os.replace(temp_path, filepath)
+
+
+# -- Reading --
+
+class StringTable(Sequence):
+    def __init__(self, buffer, base, offsets):
+        self.buffer = buffer
+        self.base = base
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_bytes(self, i):
+        return self.buffer[self.base + int(self.offsets[i]):self.base + int(self.offsets[i + 1])]
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        return self.get_bytes(i % len(self)).decode("utf-8")
+
+
+class HashedStringTable(StringTable):
+    """ A string table that can also find the position of a string through its on-disk hash table. """
+    def __init__(self, buffer, base, offsets, hashes, slots):
+        super().__init__(buffer, base, offsets)
+        self.hashes = hashes
+        self.slots = slots
+
+    def find(self, string):
+        key = string.encode("utf-8")
+        key_hash = _hash_key(key)
+        mask = len(self.slots) - 1
+        slot = key_hash & mask
+        while True:
+            index = int(self.slots[slot])
+            if index < 0:
+                return -1
+            if int(self.hashes[slot]) == key_hash and self.get_bytes(index) == key:
+                return index
+            slot = (slot + 1) & mask
+
+
+class MappedTermTable(Mapping):
+    """ Read-only stand-in for VectorLexicon.db backed by the mapped file. """
+    def __init__(self, terms, definitions, term_definitions, references, term_references):
+        self.terms = terms
+        self.definitions = definitions
+        self.term_definitions = term_definitions
+        self.references = references
+        self.term_references = term_references
+
+    def __getitem__(self, term):
+        number = self.terms.find(term) if isinstance(term, str) else -1
+        if number < 0:
+            raise KeyError(term)
+        return {
+            'definitions': [self.definitions[i] for i in range(int(self.term_definitions[number]), int(self.term_definitions[number + 1]))],
+            'references': [self.references[i] for i in range(int(self.term_references[number]), int(self.term_references[number + 1]))],
+        }
+
+    def __contains__(self, term):
+        return isinstance(term, str) and self.terms.find(term) >= 0
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+
+class MappedAliasTable(Mapping):
+    """ Read-only stand-in for VectorLexicon.alias_terms backed by the mapped file. """
+    def __init__(self, aliases, targets, alias_targets):
+        self.aliases = aliases
+        self.targets = targets
+        self.alias_targets = alias_targets
+
+    def __getitem__(self, alias):
+        number = self.aliases.find(alias) if isinstance(alias, str) else -1
+        if number < 0:
+            raise KeyError(alias)
+        return [self.targets[i] for i in range(int(self.alias_targets[number]), int(self.alias_targets[number + 1]))]
+
+    def __contains__(self, alias):
+        return isinstance(alias, str) and self.aliases.find(alias) >= 0
+
+    def __iter__(self):
+        return iter(self.aliases)
+
+    def __len__(self):
+        return len(self.aliases)
+
+
+class MappedTermsIndex(Sequence):
+    """ Read-only stand-in for VectorLexicon.terms_index: row -> (term, definition number). """
+    def __init__(self, terms, row_terms, row_definitions):
+        self.terms = terms
+        self.row_terms = row_terms
+        self.row_definitions = row_definitions
+
+    def __len__(self):
+        return len(self.row_terms)
+
+    def __getitem__(self, row):
+        return self.terms[int(self.row_terms[row])], int(self.row_definitions[row])
+
+
+class MappedLexicon:
+    def __init__(self, filepath):
+        with open(filepath, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{filepath} is not a lexicon file")
+        version, header_length = PREAMBLE.unpack_from(self.buffer, len(MAGIC))
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported lexicon format version {version} in {filepath}")
+        header_start = len(MAGIC) + PREAMBLE.size
+        header = json.loads(self.buffer[header_start:header_start + header_length].decode("utf-8"))
+        data_start = -(-(header_start + header_length) // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+        self.n_features = header['n_features']
+        self.max_key_segments = header['max_key_segments']
+
+        layout = header['sections']
+        sections = {}
+        for name, section in layout.items():
+            dtype = np.dtype(section['dtype'])
+            count = int(np.prod(section['shape'], dtype=np.int64))
+            if count:
+                array = np.frombuffer(self.buffer, dtype=dtype, count=count, offset=data_start + section['offset'])
+            else:
+                array = np.zeros(0, dtype=dtype)
+            sections[name] = array.reshape(section['shape'])
+
+        def blob_base(name):
+            return data_start + layout[name]['offset']
+
+        terms = HashedStringTable(self.buffer, blob_base('terms_blob'), sections['terms_offsets'], sections['term_hashes'], sections['term_slots'])
+        aliases = HashedStringTable(self.buffer, blob_base('aliases_blob'), sections['aliases_offsets'], sections['alias_hashes'], sections['alias_slots'])
+        self.db = MappedTermTable(
+            terms,
+            StringTable(self.buffer, blob_base('definitions_blob'), sections['definitions_offsets']),
+            sections['term_definitions'],
+            StringTable(self.buffer, blob_base('references_blob'), sections['references_offsets']),
+            sections['term_references'],
+        )
+        self.alias_terms = MappedAliasTable(aliases, StringTable(self.buffer, blob_base('alias_targets_blob'), sections['alias_targets_offsets']), sections['alias_targets'])
+        self.index = sections['vectors'] if len(sections['vectors']) else None
+        self.terms_index = MappedTermsIndex(terms, sections['row_terms'], sections['row_definitions'])
+
+
+def read_lexicon(filepath) -> MappedLexicon:
+    return MappedLexicon(filepath)
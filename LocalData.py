@@ -1,6 +1,7 @@
 # Management of Local Data and Caches
 import os
 import json
+import sqlite3
 from dotenv import load_dotenv
 from BotData import UserInfo
 
@@ -21,3 +22,9 @@ if not os.path.exists(ENV_PATH):
 def load_local_data():
     load_dotenv(ENV_PATH)
 
+def open_cache_db(filename):
+    """ Opens (or creates) a SQLite database under CACHE_PATH that can be shared across threads and bot processes. """
+    connection = sqlite3.connect(os.path.join(CACHE_PATH, filename), timeout=30, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
@@ -0,0 +1,197 @@
+# Rate-limit-aware queue for outbound chat API calls.
+# Every provider function call (sending messages, reactions, lookups) goes through its provider's OutboundQueue when
+# one is set. Calls wait for a token from their route's token buckets - one per channel for limits the provider applies
+# per channel, one for the whole route, and the provider-wide bucket, whichever are set - waiting calls are served in priority order (final answers, then reads, then cosmetic reactions), and calls rejected with a
+# rate-limit error are retried once the provider's Retry-After has passed.
+import os
+import time
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+
+import Telemetry
+
+PRIORITY_MESSAGE = 0
+PRIORITY_READ = 1
+PRIORITY_REACTION = 2
+PRIORITY_NAMES = {
+    PRIORITY_MESSAGE: "message",
+    PRIORITY_READ: "read",
+    PRIORITY_REACTION: "reaction",
+}
+# Routes are provider function names; anything not listed here is a read.
+ROUTE_PRIORITIES = {
+    'send_message': PRIORITY_MESSAGE,
+    'update_message': PRIORITY_MESSAGE,
+    'add_reaction': PRIORITY_REACTION,
+    'remove_reaction': PRIORITY_REACTION,
+}
+
+OUTBOUND_QUEUE = os.environ.get("OUTBOUND_QUEUE", "true").lower() in ("1", "true", "yes")
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", "3"))
+# Per-channel buckets kept per queue; the least recently used are dropped (a dropped bucket starts over full).
+OUTBOUND_CHANNEL_BUCKETS = 1024
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def wait_time(self, now):
+        """ Seconds until a token is available (0 if one is available now). """
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        # The provider told us to back off; one call may go once that time has passed, then the bucket refills as usual.
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 1
+        self.updated = self.paused_until
+
+
+class _Waiter:
+    def __init__(self, priority, seq, buckets, future):
+        self.priority = priority
+        self.seq = seq
+        self.buckets = buckets
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class OutboundQueue:
+    def __init__(self, name, limits, channel_limits=None, global_limit=None, get_retry_after=None):
+        """ limits maps routes to (tokens per second, burst) for the whole route, channel_limits for each channel the
+        route is called for; get_retry_after(exception) returns the number of seconds to back off if the exception is a
+        rate-limit error, otherwise None. """
+        self.name = name
+        self.buckets = {route: TokenBucket(rate, burst) for route, (rate, burst) in limits.items()}
+        self.channel_limits = channel_limits or {}
+        self.channel_buckets = OrderedDict()  # (route, channel id) -> TokenBucket
+        self.global_bucket = TokenBucket(*global_limit) if global_limit else None
+        self.get_retry_after = get_retry_after
+        self.waiting = []
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.dispatcher = None
+        self.stats = {'calls': 0, 'throttled': 0, 'throttle_wait_seconds': 0.0, 'throttle_wait_max': 0.0, 'rate_limited': 0, 'retries': 0}
+        Telemetry.register_collector(self._collect_metrics)
+
+    def queue_depths(self):
+        depths = {name: 0 for name in PRIORITY_NAMES.values()}
+        for waiter in self.waiting:
+            depths[PRIORITY_NAMES[waiter.priority]] += 1
+        return depths
+
+    def metrics(self):
+        return dict(self.stats, depth=self.queue_depths())
+
+    def _collect_metrics(self):
+        labels = {'provider': self.name}
+        samples = [("outbound_queue_depth", "gauge", dict(labels, priority=priority), depth) for priority, depth in self.queue_depths().items()]
+        samples.append(("outbound_throttle_wait_seconds_max", "gauge", labels, self.stats['throttle_wait_max']))
+        samples.extend((f"outbound_{counter}_total", "counter", labels, self.stats[counter]) for counter in ('calls', 'throttled', 'throttle_wait_seconds', 'rate_limited', 'retries'))
+        return samples
+
+    async def call(self, route, func, channel_id=None):
+        """ Runs func (a coroutine function taking no arguments) once the rate limits of the route (in channel_id, if
+        given) allow it. """
+        priority = ROUTE_PRIORITIES.get(route, PRIORITY_READ)
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            channel_bucket = self._channel_bucket(route, channel_id)
+            await self._acquire([bucket for bucket in (channel_bucket, self.buckets.get(route), self.global_bucket) if bucket is not None], priority)
+            self.stats['calls'] += 1
+            try:
+                return await func()
+            except Exception as e:
+                retry_after = self.get_retry_after(e) if self.get_retry_after else None
+                if retry_after is None:
+                    raise
+                self.stats['rate_limited'] += 1
+                if attempt == OUTBOUND_MAX_RETRIES:
+                    raise
+                self.stats['retries'] += 1
+                logging.warning(f"{self.name} rate limited on {route}; retrying in {retry_after}s")
+                (channel_bucket or self.buckets.get(route) or self._bucket_for_retry(route)).pause(retry_after)
+
+    def _bucket_for_retry(self, route):
+        # Routes without limits get a bucket the first time they're rate limited, so we can honour Retry-After.
+        self.buckets[route] = TokenBucket(1.0, 1)
+        return self.buckets[route]
+
+    def _channel_bucket(self, route, channel_id):
+        if route not in self.channel_limits or channel_id is None:
+            return None
+        key = (route, channel_id)
+        if key in self.channel_buckets:
+            self.channel_buckets.move_to_end(key)
+        else:
+            self.channel_buckets[key] = TokenBucket(*self.channel_limits[route])
+            if len(self.channel_buckets) > OUTBOUND_CHANNEL_BUCKETS:
+                self.channel_buckets.popitem(last=False)
+        return self.channel_buckets[key]
+
+    async def _acquire(self, buckets, priority):
+        if not buckets:
+            return
+        # Fast path: nothing is waiting and tokens are available.
+        now = time.monotonic()
+        if not self.waiting and all(bucket.wait_time(now) == 0 for bucket in buckets):
+            for bucket in buckets:
+                bucket.take()
+            return
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(priority, next(self.counter), buckets, loop.create_future())
+        self.waiting.append(waiter)
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        self.wakeup.set()
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self._dispatch())
+        try:
+            await waiter.future
+        finally:
+            if waiter in self.waiting:
+                self.waiting.remove(waiter)
+        wait = time.monotonic() - waiter.enqueued_at
+        self.stats['throttled'] += 1
+        self.stats['throttle_wait_seconds'] += wait
+        self.stats['throttle_wait_max'] = max(self.stats['throttle_wait_max'], wait)
+
+    async def _dispatch(self):
+        while self.waiting:
+            now = time.monotonic()
+            next_wait = None
+            granted = False
+            # Serve the highest priority waiter whose buckets have tokens; a throttled route doesn't hold up others.
+            for waiter in sorted(self.waiting, key=lambda waiter: (waiter.priority, waiter.seq)):
+                if waiter.future.done():
+                    self.waiting.remove(waiter)
+                    continue
+                wait = max(bucket.wait_time(now) for bucket in waiter.buckets)
+                if wait == 0:
+                    for bucket in waiter.buckets:
+                        bucket.take()
+                    self.waiting.remove(waiter)
+                    waiter.future.set_result(None)
+                    granted = True
+                    break
+                next_wait = wait if next_wait is None else min(next_wait, wait)
+            if granted or not self.waiting:
+                continue
+            # Sleep until a token is due or a new call arrives.
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), next_wait)
+            except asyncio.TimeoutError:
+                pass
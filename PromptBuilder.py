@@ -0,0 +1,139 @@
+# Token-budgeted prompt assembly.
+# A prompt is built from named sections, each with a priority. Sections are counted in tokens, and when the prompt
+# doesn't fit the model's budget the least important sections are cut first: sections made of lines (transcripts) lose
+# their oldest lines, other sections are shortened, or dropped once too little of them would be left. Required sections
+# are never cut. Tokens are counted with tiktoken when it's installed, otherwise estimated at four characters a token.
+import os
+import logging
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _encoding = None
+
+# Section priorities; lower is more important.
+PRIORITY_REQUIRED = 0
+PRIORITY_FILES = 1
+PRIORITY_AUTHOR = 2
+PRIORITY_SUMMARY = 3
+PRIORITY_TRANSCRIPT = 4
+PRIORITY_MENTIONED = 5
+PRIORITY_PARTICIPANTS = 6
+
+# Prompt budget in tokens, leaving room in the model's context for the response. PROMPT_TOKEN_BUDGETS overrides it
+# per model, e.g. "openhermes:7b-mistral-v2.5-fp16=6000,gpt-4-1106-preview=100000".
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "3072"))
+PROMPT_TOKEN_BUDGETS = dict(
+    (model.strip(), int(budget)) for model, budget in
+    (entry.rsplit("=", 1) for entry in os.environ.get("PROMPT_TOKEN_BUDGETS", "").split(",") if entry.strip())
+)
+# Sections that would be shortened below this many tokens are dropped instead.
+PROMPT_MIN_SECTION_TOKENS = 32
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return (len(text) + 3) // 4
+
+
+def shorten(text, tokens):
+    """ Returns the start of text, cut to about the given number of tokens. """
+    if _encoding is not None:
+        return _encoding.decode(_encoding.encode(text)[:tokens])
+    return text[:tokens * 4]
+
+
+def get_budget(model):
+    return PROMPT_TOKEN_BUDGETS.get(model, PROMPT_TOKEN_BUDGET)
+
+
+class PromptSection:
+    def __init__(self, name, priority, text="", lines=None, header="", footer=""):
+        self.name = name
+        self.priority = priority
+        self.text = text
+        self.lines = list(lines) if lines is not None else None
+        self.header = header
+        self.footer = footer
+        self.line_tokens = [count_tokens(line) for line in self.lines] if self.lines is not None else None
+        self.original_tokens = self.tokens()
+        self.dropped_lines = 0
+        self.shortened = False
+
+    def is_empty(self):
+        return not self.lines if self.lines is not None else not self.text
+
+    def tokens(self):
+        if self.is_empty():
+            return 0
+        if self.lines is not None:
+            return count_tokens(self.header) + sum(self.line_tokens) + count_tokens(self.footer)
+        return count_tokens(self.header) + count_tokens(self.text) + count_tokens(self.footer)
+
+    def render(self):
+        if self.is_empty():
+            return ""
+        body = "".join(self.lines) if self.lines is not None else self.text
+        return self.header + body + self.footer
+
+    def cut(self, excess):
+        """ Cuts about excess tokens from the section, returns how many were cut. """
+        before = self.tokens()
+        if self.lines is not None:
+            # Oldest lines go first.
+            cut = 0
+            while self.lines and cut < excess:
+                self.lines.pop(0)
+                cut += self.line_tokens.pop(0)
+                self.dropped_lines += 1
+        else:
+            # What's left for the text once the header and footer are paid for; too little and the section goes.
+            tokens = max(0, before - excess - count_tokens(self.header) - count_tokens(self.footer))
+            if before - excess >= PROMPT_MIN_SECTION_TOKENS and tokens > 0:
+                self.text = shorten(self.text, tokens) + "...\n"
+                self.shortened = True
+            else:
+                self.text = ""
+        return before - self.tokens()
+
+
+class PromptBuilder:
+    def __init__(self, model, budget=None):
+        self.model = model
+        self.budget = budget if budget is not None else get_budget(model)
+        self.sections = []
+
+    def add(self, name, text, priority=PRIORITY_REQUIRED, header="", footer=""):
+        self.sections.append(PromptSection(name, priority, text=text, header=header, footer=footer))
+
+    def add_lines(self, name, lines, priority, header="", footer=""):
+        """ Adds a section whose oldest lines are dropped first when the prompt is over budget. """
+        self.sections.append(PromptSection(name, priority, lines=lines, header=header, footer=footer))
+
+    def total_tokens(self):
+        return sum(section.tokens() for section in self.sections)
+
+    def build(self) -> str:
+        excess = self.total_tokens() - self.budget
+        # Least important sections first; among equals, the ones added last.
+        order = sorted(enumerate(self.sections), key=lambda item: (-item[1].priority, -item[0]))
+        for _, section in order:
+            if excess <= 0:
+                break
+            if section.priority == PRIORITY_REQUIRED or section.is_empty():
+                continue
+            excess -= section.cut(excess)
+        if excess > 0:
+            logging.warning(f"Prompt for {self.model} is {excess} tokens over its budget of {self.budget} with only required sections left")
+        return "".join(section.render() for section in self.sections)
+
+    def report(self):
+        """ Tokens used by each section, and how much of it was cut to fit the budget. """
+        return {
+            section.name: {'tokens': section.tokens(), 'original_tokens': section.original_tokens, 'dropped_lines': section.dropped_lines, 'shortened': section.shortened}
+            for section in self.sections
+        }
@@ -0,0 +1,40 @@
+# Management of the LLM Response Cache
+# Responses to deterministic requests (temperature at or below LLM_RESPONSE_CACHE_MAX_TEMPERATURE) are stored in
+# SQLite, keyed by a hash of the normalized prompt, model, temperature, system message and any other request options.
+import os
+import re
+import json
+import hashlib
+import BoundedCache
+import Telemetry
+
+LLM_RESPONSE_CACHE = os.environ.get("LLM_RESPONSE_CACHE", "true").lower() in ("1", "true", "yes")
+LLM_RESPONSE_CACHE_TTL = float(os.environ.get("LLM_RESPONSE_CACHE_TTL", str(7 * 24 * 60 * 60)))
+LLM_RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_RESPONSE_CACHE_MAX_ENTRIES", "50000"))
+LLM_RESPONSE_CACHE_MAX_TEMPERATURE = float(os.environ.get("LLM_RESPONSE_CACHE_MAX_TEMPERATURE", "0"))
+
+_cache = BoundedCache.BoundedCache("llm_response_cache.db", "responses", ("key",), "response", LLM_RESPONSE_CACHE_TTL, LLM_RESPONSE_CACHE_MAX_ENTRIES, eviction_interval=500)
+stats = _cache.stats
+Telemetry.register_cache("llm_response", stats)
+
+
+def is_cacheable(temperature):
+    # Only deterministic settings are cached; None means the backend's (non-zero) default temperature.
+    return LLM_RESPONSE_CACHE and temperature is not None and temperature <= LLM_RESPONSE_CACHE_MAX_TEMPERATURE
+
+
+def normalize_prompt(prompt):
+    return re.sub(r"\s+", " ", prompt).strip()
+
+
+def make_key(kind, model, prompt, temperature, system_message, **options):
+    key_data = json.dumps([kind, model, normalize_prompt(prompt), temperature, system_message, options], sort_keys=True, default=str)
+    return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+
+def lookup_response(key):
+    return _cache.lookup(key)
+
+
+def add_response(key, response):
+    _cache.add(key, response)
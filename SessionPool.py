@@ -0,0 +1,45 @@
+# Management of shared, pooled HTTP sessions.
+# Opening a new aiohttp.ClientSession per request throws away keep-alive connections and DNS/TLS state,
+# so every part of the bot that talks HTTP should borrow one of these long-lived sessions instead.
+import os
+import asyncio
+import aiohttp
+
+HTTP_POOL_LIMIT = int(os.environ.get("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get("HTTP_POOL_LIMIT_PER_HOST", "10"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_REQUEST_TIMEOUT = float(os.environ.get("HTTP_REQUEST_TIMEOUT", "120"))
+
+# Sessions are bound to the event loop that created them, so they are keyed by (name, loop).
+_SESSIONS = {}
+
+
+def _default_headers(name):
+    # Slack file downloads need the bot token on every request.
+    if name == "slack":
+        return {"Authorization": f"Bearer {os.environ.get('SLACK_BOT_TOKEN')}"}
+    return {}
+
+
+def get_session(name="default", headers=None) -> aiohttp.ClientSession:
+    """ Returns the process-wide pooled session for the given name (e.g. a platform), creating it on first use. """
+    loop = asyncio.get_running_loop()
+    key = (name, loop)
+    session = _SESSIONS.get(key)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_POOL_LIMIT, limit_per_host=HTTP_POOL_LIMIT_PER_HOST, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+        session_headers = _default_headers(name)
+        if headers:
+            session_headers.update(headers)
+        session = aiohttp.ClientSession(connector=connector, headers=session_headers, timeout=aiohttp.ClientTimeout(total=HTTP_REQUEST_TIMEOUT))
+        _SESSIONS[key] = session
+    return session
+
+
+async def close_sessions():
+    """ Closes every pooled session owned by the running event loop. """
+    loop = asyncio.get_running_loop()
+    for key in [key for key in _SESSIONS if key[1] is loop]:
+        session = _SESSIONS.pop(key)
+        if not session.closed:
+            await session.close()
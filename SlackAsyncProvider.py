@@ -0,0 +1,268 @@
+# Slack provider built on bolt's AsyncApp and the AsyncWebClient.
+# Events are handled and every Slack API call is made on one event loop, over the pooled aiohttp session, so there are
+# no hops to executor threads or to a second event loop. Select it with SLACK_ASYNC_MODE=true.
+import os
+import asyncio
+import logging
+
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_sdk.web.async_client import AsyncWebClient
+
+from BotData import UserInfo, ReactionEvent, MessageEvent, Message, ProviderFunctionsBase
+import UserProfile
+import OutboundQueue
+import SessionPool
+from SlackCommon import (translate_reaction, build_send_params, replies_params, create_user_info, create_bot_info,
+                         create_reaction_added_event, create_message_event_from_slack_message, ThreadSnapshot,
+                         get_snapshot, get_fresh_snapshot, store_thread_snapshot, refresh_thread_snapshot, update_thread_snapshot, record_sent_message,
+                         find_cached_message, SLACK_RATE_LIMITS, SLACK_CHANNEL_RATE_LIMITS, slack_retry_after)
+
+# Check for slack token and if not present, call localdata to load it
+if not os.environ.get("SLACK_BOT_TOKEN"):
+    import LocalData
+    LocalData.load_local_data()
+
+# The app is created on the event loop in create_bot, since its client's session belongs to that loop.
+app = None
+
+_thread_fetches = {}  # (channel id, thread ts) -> task fetching the thread
+
+
+async def _fetch_thread_messages(bot: UserInfo, channel_id, thread_ts, oldest=None):
+    messages = []
+    cursor = None
+    while True:
+        response = await bot.bot_client.conversations_replies(**replies_params(channel_id, thread_ts, cursor, oldest))
+        if not response["ok"]:
+            logging.error(f"Error fetching thread messages: {response['error']}")
+            return None
+        messages.extend(response.get("messages", []))
+        cursor = response.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            return messages
+
+
+async def get_thread_snapshot(bot: UserInfo, channel_id, thread_ts) -> ThreadSnapshot:
+    """ Returns a fresh snapshot of the thread, fetching it if needed. None if the thread couldn't be fetched. """
+    snapshot = get_fresh_snapshot(channel_id, thread_ts)
+    if snapshot is not None:
+        return snapshot
+
+    # Concurrent requests for the same thread share one fetch.
+    key = (channel_id, thread_ts)
+    fetch = _thread_fetches.get(key)
+    if fetch is None:
+        async def fetch_snapshot():
+            try:
+                snapshot = get_snapshot(channel_id, thread_ts)
+                if snapshot is not None and snapshot.fetched_ts is not None:
+                    # We still have the thread up to some reply; only fetch the ones after it.
+                    messages = await _fetch_thread_messages(bot, channel_id, thread_ts, oldest=snapshot.fetched_ts)
+                    if messages is None:
+                        return None
+                    refresh_thread_snapshot(snapshot, messages)
+                    return snapshot
+                messages = await _fetch_thread_messages(bot, channel_id, thread_ts)
+                if messages is None:
+                    return None
+                snapshot = ThreadSnapshot(channel_id, thread_ts, messages)
+                store_thread_snapshot(snapshot)
+                return snapshot
+            finally:
+                _thread_fetches.pop(key, None)
+        fetch = asyncio.ensure_future(fetch_snapshot())
+        _thread_fetches[key] = fetch
+    return await asyncio.shield(fetch)
+
+
+# --- Provider Functions ---
+
+async def send_message(bot: UserInfo, message: Message):
+    params = build_send_params(message)
+
+    # Send the message using the Slack client
+    response = await bot.bot_client.chat_postMessage(**params)
+    record_sent_message(bot, params, response["ts"])
+    return response["ts"]
+
+
+async def update_message(bot: UserInfo, message: Message):
+    await bot.bot_client.chat_update(
+        channel=message.channel,
+        ts=message.message_id,
+        text=message.text
+    )
+    return message.message_id
+
+
+async def add_reaction(bot: UserInfo, reaction: ReactionEvent):
+    translate_reaction(reaction)
+    await bot.bot_client.reactions_add(
+        channel=reaction.channel_id,
+        name=reaction.reaction,
+        timestamp=reaction.message_id
+    )
+
+
+async def remove_reaction(bot: UserInfo, reaction: ReactionEvent):
+    translate_reaction(reaction)
+    await bot.bot_client.reactions_remove(
+        channel=reaction.channel_id,
+        name=reaction.reaction,
+        timestamp=reaction.message_id
+    )
+
+async def get_user_info(bot: UserInfo, user_id: str) -> UserInfo:
+    user_info = UserProfile.lookup_userinfo(user_id)
+    if user_info:
+        return user_info
+
+    response = await bot.bot_client.users_info(user=user_id)
+    if not response["ok"]:
+        logging.error(f"Error getting user info for {user_id}: {response['error']}")
+        return None
+    user_info = create_user_info(response["user"])
+    UserProfile.add_userinfo_to_cache(user_info)
+    return user_info
+
+
+async def get_message_info(bot: UserInfo, channel_id: str, message_id: str) -> Message:
+    cached_message = find_cached_message(channel_id, message_id)
+    if cached_message is not None:
+        return create_message_event_from_slack_message(bot, channel_id, cached_message)
+
+    response = await bot.bot_client.conversations_history(channel=channel_id, latest=message_id, inclusive=True, include_all_metadata=True, limit=1)
+    if not response["ok"]:
+        logging.error(f"Error getting message info for {message_id}: {response['error']}")
+        return None
+    if not 'messages' in response:
+        logging.error(f"No messages found for {message_id}")
+        return None
+
+    return create_message_event_from_slack_message(bot, channel_id, response["messages"][0])
+
+
+async def get_messages_from_channel(bot: UserInfo, channel_id: str) -> list[MessageEvent]:
+    response = await bot.bot_client.conversations_history(channel=channel_id, include_all_metadata=True, limit=1000)
+    if not response["ok"]:
+        logging.error(f"Error getting messages from channel {channel_id}: {response['error']}")
+        return None
+    if not 'messages' in response:
+        logging.error(f"No messages found for channel {channel_id}")
+        return None
+    messages = [create_message_event_from_slack_message(bot, channel_id, message_content) for message_content in response["messages"]]
+
+    # Reverse the order of the messages because they're returned in reverse chronological order
+    messages.reverse()
+    return messages
+
+async def get_messages_from_thread(bot: UserInfo, channel_id: str, thread_id: str) -> list[MessageEvent]:
+    snapshot = await get_thread_snapshot(bot, channel_id, thread_id)
+    if snapshot is None:
+        return None
+    return [create_message_event_from_slack_message(bot, channel_id, message_content) for message_content in snapshot.message_list()]
+
+async def get_thread_participants(bot:UserInfo, channel_id:str, thread_id:str) -> list[str]:
+    try:
+        snapshot = await get_thread_snapshot(bot, channel_id, thread_id)
+        if snapshot is None:
+            return []
+
+        # Extract unique user IDs from the messages
+        return snapshot.participants()
+
+    except Exception as e:
+        # Let the outbound queue retry rate-limited fetches.
+        if slack_retry_after(e) is not None:
+            raise
+        logging.error(f"Error in get_thread_participants: {str(e)}")
+        return []
+
+
+async def get_previous_messages(bot, channel_id, message_ts=None, thread_ts=None):
+    try:
+        snapshot = await get_thread_snapshot(bot, channel_id, thread_ts)
+        if snapshot is None:
+            return []
+
+        # Messages the conversation state already has are skipped by id.
+        return [create_message_event_from_slack_message(bot, channel_id, msg) for msg in snapshot.message_list()]
+
+    except Exception as e:
+        # Let the outbound queue retry rate-limited fetches.
+        if slack_retry_after(e) is not None:
+            raise
+        logging.error(f"Error in get_previous_messages_slack: {str(e)}")
+        return []
+
+
+
+slack_bot_function_handler = ProviderFunctionsBase()
+slack_bot_function_handler.max_message_length = 4000
+slack_bot_function_handler.send_message = send_message
+slack_bot_function_handler.update_message = update_message
+slack_bot_function_handler.add_reaction = add_reaction
+slack_bot_function_handler.remove_reaction = remove_reaction
+slack_bot_function_handler.get_user_info = get_user_info
+slack_bot_function_handler.get_message_info = get_message_info
+slack_bot_function_handler.get_messages_from_channel = get_messages_from_channel
+slack_bot_function_handler.get_messages_from_thread = get_messages_from_thread
+slack_bot_function_handler.get_thread_participants = get_thread_participants
+slack_bot_function_handler.get_previous_messages = get_previous_messages
+if OutboundQueue.OUTBOUND_QUEUE:
+    slack_bot_function_handler.outbound_queue = OutboundQueue.OutboundQueue("slack", SLACK_RATE_LIMITS, channel_limits=SLACK_CHANNEL_RATE_LIMITS, get_retry_after=slack_retry_after)
+
+# -- Internal Helpers --
+def _get_bot_info(context):
+    return create_bot_info(context, app.client, slack_bot_function_handler)
+
+
+# -- Event Handlers --
+
+async def handle_message_events(event, context):
+    update_thread_snapshot(event)
+    # Ignore deleted and changed messages
+    if event.get('subtype', None) == 'message_deleted' or event.get('subtype', None) == 'message_changed':
+        return
+    # Don't process our own messages
+    if event.get('user', None) == context.bot_user_id:
+        return
+
+    bot_info = _get_bot_info(context)
+
+    event_info = create_message_event_from_slack_message(bot_info, event.get("channel",None), event)
+
+    # Bolt acknowledges the event once we return, so run the workflow in the background.
+    asyncio.create_task(event_handler(bot_info, "message", event_info))
+
+async def handle_reaction_added_events(event, context):
+    bot_info = _get_bot_info(context)
+    reaction_info = create_reaction_added_event(event)
+    asyncio.create_task(event_handler(bot_info, "reaction_added", reaction_info))
+
+
+# This is meant to be replaced by whatever handler you need.
+def event_handler(bot_info, event_type, event_data):
+    raise NotImplementedError
+
+
+async def _run():
+    global app
+    client = AsyncWebClient(token=os.environ.get("SLACK_BOT_TOKEN"), session=SessionPool.get_session("slack-api"))
+    app = AsyncApp(client=client)
+    app.event("message")(handle_message_events)
+    app.event("reaction_added")(handle_reaction_added_events)
+    try:
+        await AsyncSocketModeHandler(app, os.environ.get("SLACK_APP_TOKEN")).start_async()
+    finally:
+        await SessionPool.close_sessions()
+
+
+# --- Public Function Class ---
+def create_bot(custom_event_handler=None):
+    if(custom_event_handler):
+        global event_handler
+        event_handler = custom_event_handler
+
+    asyncio.run(_run())
@@ -0,0 +1,272 @@
+# Helpers shared by the Slack providers (SlackProvider and SlackAsyncProvider): translating Slack payloads into our
+# data types, and the in-memory thread snapshots. Nothing in here talks to Slack.
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from BotData import UserInfo, ReactionEvent, MessageEvent, EmbeddedFile, EmbeddedLink, Message
+
+REACTION_DB = {
+    'looking': 'eyes',
+    'thinking':'brain',
+    'thumbs_up':'thumbsup',
+    'thumbs_down':'thumbsdown',
+    'green_check':'white_check_mark',
+    'process_image':'frame_with_picture',
+    'phase_context_gathering': 'eyes',
+    'phase_enrichment':'frame_with_picture',
+    'phase_processing': 'brain',
+    'phase_validation': 'mag',
+    'phase_request_complete': 'white_check_mark',
+    'phase_request_failed': 'x'
+}
+
+# Thread snapshots: each thread is fetched (all pages) once and then served from memory for SLACK_THREAD_SNAPSHOT_TTL
+# seconds, so the participant check, the history and message lookups of a request, and of a burst of requests in the
+# same thread, share one fetch. Incoming events keep the snapshot current in between. Once a kept snapshot is stale,
+# only the replies newer than the newest one fetched so far are fetched and merged into it.
+SLACK_THREAD_SNAPSHOT_TTL = float(os.environ.get("SLACK_THREAD_SNAPSHOT_TTL", "30"))
+SLACK_THREAD_SNAPSHOT_MAX = int(os.environ.get("SLACK_THREAD_SNAPSHOT_MAX", "256"))
+SLACK_REPLIES_PAGE_SIZE = 200
+
+# Outbound rate limits, as (calls per second, burst), following the tier of the Web API method behind each provider
+# function. Tier limits apply to the method across the whole workspace: chat.update and reactions.* are Tier 3 (50+ per
+# minute), users.info is Tier 4 (100+ per minute). chat.postMessage allows about one message per second per channel,
+# so messages to different channels don't wait on each other. Thread lookups are usually served from snapshots, so
+# they are only retried when Slack rate limits the fetch behind them.
+SLACK_RATE_LIMITS = {
+    'update_message': (50 / 60, 10),
+    'add_reaction': (50 / 60, 10),
+    'remove_reaction': (50 / 60, 10),
+    'get_user_info': (100 / 60, 20),
+    'get_message_info': (50 / 60, 10),
+    'get_messages_from_channel': (50 / 60, 5),
+}
+SLACK_CHANNEL_RATE_LIMITS = {
+    'send_message': (1.0, 3),
+}
+
+
+def slack_retry_after(exception):
+    """ Seconds to wait before retrying if exception is a Slack rate-limit error (HTTP 429), otherwise None. """
+    response = getattr(exception, "response", None)
+    if getattr(response, "status_code", None) != 429:
+        return None
+    headers = getattr(response, "headers", None) or {}
+    retry_after = headers.get("Retry-After", headers.get("retry-after", 1))
+    return float(retry_after)
+
+
+def translate_reaction(reaction: ReactionEvent):
+    # Translate Reaction to Slack's format
+    if reaction.reaction in REACTION_DB:
+        reaction.reaction = REACTION_DB[reaction.reaction]
+
+
+def build_send_params(message: Message) -> dict:
+    params = {
+        "channel": message.channel,
+        "text": message.text,
+        "attachments": message.attachments,
+        "reply_broadcast":True
+    }
+
+    # Determine if the message is a reply to a parent message
+    if message.parent_message_id:
+        params["thread_ts"] = message.parent_message_id
+    # If not a reply, but intended for a thread, set thread_ts to the thread ID
+    elif message.thread_id:
+        params["thread_ts"] = message.thread_id
+    return params
+
+
+def replies_params(channel_id, thread_ts, cursor=None, oldest=None) -> dict:
+    params = {"channel": channel_id, "ts": thread_ts, "limit": SLACK_REPLIES_PAGE_SIZE, "include_all_metadata": True}
+    if cursor:
+        params["cursor"] = cursor
+    if oldest:
+        # Only replies after this ts (Slack's oldest is exclusive by default).
+        params["oldest"] = oldest
+    return params
+
+
+def create_user_info(uinfo: dict) -> UserInfo:
+    user_info = UserInfo()
+    user_info.id = uinfo["id"]
+    user_info.platform = "slack"
+    user_info.mention_tag = f"<@{user_info.id}>"
+    user_info.username = uinfo['name']
+    user_info.real_name = uinfo['real_name']
+    user_info.title = uinfo['profile']['title']
+    user_info.team = uinfo['team_id']
+    user_info.is_bot = uinfo['is_bot']
+    user_info.status = uinfo['profile']['status_text']
+    return user_info
+
+
+def create_bot_info(context, client, bot_functions) -> UserInfo:
+    bot_info = UserInfo()
+    bot_info.id = context.bot_user_id
+    bot_info.platform = "slack"
+    bot_info.mention_tag = f"<@{context.bot_user_id}>"
+    bot_info.username = "Slack Bot"
+    bot_info.real_name = "Slackery Bottonson"
+    bot_info.title = "Slack Bot"
+    bot_info.is_bot = True
+    bot_info.bot_client = client
+    bot_info.bot_functions = bot_functions
+    return bot_info
+
+
+def create_reaction_added_event(event) -> ReactionEvent:
+    reaction_info = ReactionEvent()
+    reaction_info.reaction = event["reaction"]
+    reaction_info.user_id = event["user"]
+    reaction_info.message_id = event["item"]["ts"]
+    return reaction_info
+
+
+def create_message_event_from_slack_message(bot: UserInfo, channel_id: str, message_content: dict) -> MessageEvent:
+    message_info = MessageEvent()
+    message_info.text = message_content.get("text", "")
+    message_info.direct_mention_bot = bot.mention_tag in message_info.text
+    message_info.is_direct_message_channel = message_content.get("channel_type", None) == 'im'
+    message_info.user_id = message_content.get("user", None)
+    message_info.message_id = message_content.get("ts", None)
+    message_info.channel_id = message_content.get("channel", channel_id)
+    message_info.thread_id = message_content.get("thread_ts", None)
+
+
+    # Handle Embedded Files
+    if "files" in message_content:
+        for file in message_content["files"]:
+            file_info = EmbeddedFile()
+            file_info.name = file["name"]
+            file_info.url = file["url_private_download"]
+            file_info.file_type = file["mimetype"]
+            message_info.files.append(file_info)
+
+    # Handle Embedded Links
+    if "blocks" in message_content:
+        for block in message_content["blocks"]:
+            if block["type"] == "rich_text":
+                for element in block["elements"]:
+                    if element["type"] == "rich_text_section":
+                        for link in element["elements"]:
+                            if link["type"] == "link":
+                                link_info = EmbeddedLink()
+                                link_info.url = link["url"]
+                                message_info.links.append(link_info)
+
+    # Handler Reactions
+    if "reactions" in message_content:
+        for reaction in message_content["reactions"]:
+            reaction_info = ReactionEvent()
+            reaction_info.reaction = reaction["name"]
+            reaction_info.user_id = reaction["users"]
+            reaction_info.count = reaction.get("count", len(reaction["users"]))
+            reaction_info.message_id = message_content["ts"]
+            reaction_info.channel_id = message_content.get("channel",channel_id)
+            message_info.reactions.append(reaction_info)
+
+    return message_info
+
+
+# -- Thread Snapshots --
+
+class ThreadSnapshot:
+    def __init__(self, channel_id, thread_ts, messages):
+        self.channel_id = channel_id
+        self.thread_ts = thread_ts
+        self.fetched_at = time.monotonic()
+        self.messages = OrderedDict((message["ts"], message) for message in messages)
+        # Newest message fetched from Slack; our own replies and event updates don't move it, since they may be newer
+        # than replies that haven't been fetched yet.
+        self.fetched_ts = max(self.messages, key=float, default=None)
+
+    def is_fresh(self):
+        return time.monotonic() - self.fetched_at < SLACK_THREAD_SNAPSHOT_TTL
+
+    def add_message(self, message):
+        self.messages[message["ts"]] = message
+        # Keep the messages in chronological order.
+        if len(self.messages) > 1 and float(next(reversed(self.messages))) < float(list(self.messages)[-2]):
+            self.messages = OrderedDict(sorted(self.messages.items(), key=lambda item: float(item[0])))
+
+    def remove_message(self, ts):
+        self.messages.pop(ts, None)
+
+    def participants(self):
+        return list(dict.fromkeys(message.get('user') for message in self.messages.values()))
+
+    def message_list(self):
+        return list(self.messages.values())
+
+
+_thread_snapshots = OrderedDict()  # (channel id, thread ts) -> ThreadSnapshot
+# Guards _thread_snapshots; held only briefly, so it's safe to take from the event loop too.
+_thread_snapshot_lock = threading.Lock()
+
+
+def get_snapshot(channel_id, thread_ts):
+    """ Returns the kept snapshot of a thread, fresh or not, or None. """
+    with _thread_snapshot_lock:
+        return _thread_snapshots.get((channel_id, thread_ts))
+
+
+def get_fresh_snapshot(channel_id, thread_ts):
+    snapshot = get_snapshot(channel_id, thread_ts)
+    if snapshot is not None and snapshot.is_fresh():
+        return snapshot
+    return None
+
+
+def refresh_thread_snapshot(snapshot: ThreadSnapshot, messages):
+    """ Merges newly fetched messages into a kept snapshot and marks it fresh again. """
+    with _thread_snapshot_lock:
+        for message in messages:
+            snapshot.add_message(message)
+        snapshot.fetched_ts = max([snapshot.fetched_ts] + [message["ts"] for message in messages], key=lambda ts: float(ts or 0))
+        snapshot.fetched_at = time.monotonic()
+
+
+def store_thread_snapshot(snapshot: ThreadSnapshot):
+    """ Stores a snapshot, evicting the least recently stored ones beyond SLACK_THREAD_SNAPSHOT_MAX. """
+    key = (snapshot.channel_id, snapshot.thread_ts)
+    with _thread_snapshot_lock:
+        _thread_snapshots[key] = snapshot
+        _thread_snapshots.move_to_end(key)
+        while len(_thread_snapshots) > SLACK_THREAD_SNAPSHOT_MAX:
+            _thread_snapshots.popitem(last=False)
+
+
+def update_thread_snapshot(event):
+    """ Applies a message event (new, changed or deleted message) to the snapshot of its thread, if we have one. """
+    subtype = event.get('subtype', None)
+    message = event.get('message', event) if subtype == 'message_changed' else event
+    thread_ts = message.get('thread_ts', None) or event.get('previous_message', {}).get('thread_ts', None)
+    if thread_ts is None:
+        return
+    with _thread_snapshot_lock:
+        snapshot = _thread_snapshots.get((event.get('channel', None), thread_ts))
+        if snapshot is None:
+            return
+        if subtype == 'message_deleted':
+            snapshot.remove_message(event.get('deleted_ts', None))
+        elif 'ts' in message:
+            snapshot.add_message(message)
+
+
+def record_sent_message(bot: UserInfo, params: dict, ts):
+    # Our own messages don't come back to us as events, so add them to the thread's snapshot here.
+    if "thread_ts" in params:
+        update_thread_snapshot({"channel": params["channel"], "ts": ts, "thread_ts": params["thread_ts"], "user": bot.id, "text": params["text"]})
+
+
+def find_cached_message(channel_id, ts):
+    with _thread_snapshot_lock:
+        for (snapshot_channel_id, _), snapshot in _thread_snapshots.items():
+            if snapshot_channel_id == channel_id and snapshot.is_fresh() and ts in snapshot.messages:
+                return snapshot.messages[ts]
+    return None
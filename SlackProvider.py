@@ -3,11 +3,16 @@ import os
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 
-from BotData import UserInfo, ReactionEvent, MessageEvent, EmbeddedFile, EmbeddedLink, Message, ProviderFunctionsBase
+from BotData import UserInfo, ReactionEvent, MessageEvent, Message, ProviderFunctionsBase
 import logging
 import asyncio
 import threading
 import UserProfile
+import OutboundQueue
+from SlackCommon import (translate_reaction, build_send_params, replies_params, create_user_info, create_bot_info,
+                         create_reaction_added_event, create_message_event_from_slack_message, ThreadSnapshot,
+                         get_snapshot, get_fresh_snapshot, store_thread_snapshot, refresh_thread_snapshot, update_thread_snapshot, record_sent_message,
+                         find_cached_message, SLACK_RATE_LIMITS, SLACK_CHANNEL_RATE_LIMITS, slack_retry_after)
 
 # Check for slack token and if not present, call localdata to load it
 if not os.environ.get("SLACK_BOT_TOKEN"):
@@ -27,46 +32,88 @@ t = threading.Thread(target=start_loop, args=(new_loop,))
 t.start()
 
 
-REACTION_DB = {
-    'looking': 'eyes',
-    'thinking':'brain',
-    'thumbs_up':'thumbsup',
-    'thumbs_down':'thumbsdown',
-    'green_check':'white_check_mark',
-    'process_image':'frame_with_picture',
-    'phase_context_gathering': 'eyes',
-    'phase_enrichment':'frame_with_picture',
-    'phase_processing': 'brain',
-    'phase_validation': 'mag',
-    'phase_request_complete': 'white_check_mark',
-    'phase_request_failed': 'x'
-}
+# (channel id, thread ts) -> [lock held while the thread is being fetched, number of requests using it]. An entry is
+# removed once no request uses it, so failed fetches don't leave locks behind.
+_thread_fetch_locks = {}
+_thread_fetch_locks_lock = threading.Lock()
+
+
+def _fetch_thread_messages(bot: UserInfo, channel_id, thread_ts, oldest=None):
+    messages = []
+    cursor = None
+    while True:
+        response = bot.bot_client.conversations_replies(**replies_params(channel_id, thread_ts, cursor, oldest))
+        if not response["ok"]:
+            logging.error(f"Error fetching thread messages: {response['error']}")
+            return None
+        messages.extend(response.get("messages", []))
+        cursor = response.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            return messages
+
+
+def _refresh_thread_snapshot(bot: UserInfo, channel_id, thread_ts) -> ThreadSnapshot:
+    snapshot = get_fresh_snapshot(channel_id, thread_ts)
+    if snapshot is not None:
+        return snapshot
+    snapshot = get_snapshot(channel_id, thread_ts)
+    if snapshot is not None and snapshot.fetched_ts is not None:
+        # We still have the thread up to some reply; only fetch the ones after it.
+        messages = _fetch_thread_messages(bot, channel_id, thread_ts, oldest=snapshot.fetched_ts)
+        if messages is None:
+            return None
+        refresh_thread_snapshot(snapshot, messages)
+        return snapshot
+    messages = _fetch_thread_messages(bot, channel_id, thread_ts)
+    if messages is None:
+        return None
+    snapshot = ThreadSnapshot(channel_id, thread_ts, messages)
+    store_thread_snapshot(snapshot)
+    return snapshot
+
+
+def get_thread_snapshot(bot: UserInfo, channel_id, thread_ts) -> ThreadSnapshot:
+    """ Returns a fresh snapshot of the thread, fetching it if needed. None if the thread couldn't be fetched. """
+    snapshot = get_fresh_snapshot(channel_id, thread_ts)
+    if snapshot is not None:
+        return snapshot
+    key = (channel_id, thread_ts)
+    with _thread_fetch_locks_lock:
+        entry = _thread_fetch_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        # Only one thread fetches; concurrent requests for the same thread wait and use its result.
+        with entry[0]:
+            return _refresh_thread_snapshot(bot, channel_id, thread_ts)
+    finally:
+        with _thread_fetch_locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _thread_fetch_locks[key]
+
 
 # --- Provider Functions ---
 
 def send_message(bot: UserInfo, message: Message):
-    params = {
-        "channel": message.channel,
-        "text": message.text,
-        "attachments": message.attachments,
-        "reply_broadcast":True
-    }
-
-    # Determine if the message is a reply to a parent message
-    if message.parent_message_id:
-        params["thread_ts"] = message.parent_message_id
-    # If not a reply, but intended for a thread, set thread_ts to the thread ID
-    elif message.thread_id:
-        params["thread_ts"] = message.thread_id
+    params = build_send_params(message)
 
     # Send the message using the Slack client
-    bot.bot_client.chat_postMessage(**params)
+    response = bot.bot_client.chat_postMessage(**params)
+    record_sent_message(bot, params, response["ts"])
+    return response["ts"]
+
+
+def update_message(bot: UserInfo, message: Message):
+    bot.bot_client.chat_update(
+        channel=message.channel,
+        ts=message.message_id,
+        text=message.text
+    )
+    return message.message_id
 
 
 def add_reaction(bot: UserInfo, reaction: ReactionEvent):
-    # Translate Reaction to Slack's format
-    if reaction.reaction in REACTION_DB:
-        reaction.reaction = REACTION_DB[reaction.reaction]
+    translate_reaction(reaction)
     bot.bot_client.reactions_add(
         channel=reaction.channel_id,
         name=reaction.reaction,
@@ -75,9 +122,7 @@ def add_reaction(bot: UserInfo, reaction: ReactionEvent):
 
 
 def remove_reaction(bot: UserInfo, reaction: ReactionEvent):
-    # Translate Reaction to Slack's format
-    if reaction.reaction in REACTION_DB:
-        reaction.reaction = REACTION_DB[reaction.reaction]    
+    translate_reaction(reaction)
     bot.bot_client.reactions_remove(
         channel=reaction.channel_id,        
         name=reaction.reaction,
@@ -89,71 +134,20 @@ def get_user_info(bot: UserInfo, user_id: str) -> UserInfo:
     if user_info:
         return user_info
 
-    user_info = UserInfo()
     response = bot.bot_client.users_info(user=user_id)
     if not response["ok"]:
         logging.error(f"Error getting user info for {user_id}: {response['error']}")
         return None
-    uinfo = response["user"]
-
-    user_info.id = uinfo["id"]
-    user_info.platform = "slack"
-    user_info.mention_tag = f"<@{user_info.id}>"
-    user_info.username = uinfo['name']
-    user_info.real_name = uinfo['real_name']
-    user_info.title = uinfo['profile']['title']
-    user_info.team = uinfo['team_id']
-    user_info.is_bot = uinfo['is_bot']
-    user_info.status = uinfo['profile']['status_text']
+    user_info = create_user_info(response["user"])
     UserProfile.add_userinfo_to_cache(user_info)
     return user_info
 
 
-def _create_message_event_from_slack_message(bot: UserInfo, channel_id: str, message_content: dict) -> MessageEvent:
-    message_info = MessageEvent()
-    message_info.text = message_content.get("text", "")   
-    message_info.direct_mention_bot = bot.mention_tag in message_info.text
-    message_info.is_direct_message_channel = message_content.get("channel_type", None) == 'im'
-    message_info.user_id = message_content.get("user", None)
-    message_info.message_id = message_content.get("ts", None)
-    message_info.channel_id = message_content.get("channel", channel_id)
-    message_info.thread_id = message_content.get("thread_ts", None)
-
-
-    # Handle Embedded Files
-    if "files" in message_content:
-        for file in message_content["files"]:
-            file_info = EmbeddedFile()
-            file_info.name = file["name"]
-            file_info.url = file["url_private_download"]
-            file_info.file_type = file["mimetype"]
-            message_info.files.append(file_info)
-
-    # Handle Embedded Links
-    if "blocks" in message_content:
-        for block in message_content["blocks"]:
-            if block["type"] == "rich_text":
-                for element in block["elements"]:
-                    if element["type"] == "rich_text_section":
-                        for link in element["elements"]:
-                            if link["type"] == "link":
-                                link_info = EmbeddedLink()
-                                link_info.url = link["url"]
-                                message_info.links.append(link_info)
-  
-    # Handler Reactions
-    if "reactions" in message_content:
-        for reaction in message_content["reactions"]:
-            reaction_info = ReactionEvent()
-            reaction_info.reaction = reaction["name"]
-            reaction_info.user_id = reaction["users"]
-            reaction_info.message_id = message_content["ts"]
-            reaction_info.channel_id = message_content.get("channel",channel_id)
-            message_info.reactions.append(reaction_info)
-    
-    return message_info
-
 def get_message_info(bot: UserInfo, channel_id: str, message_id: str) -> Message:
+    cached_message = find_cached_message(channel_id, message_id)
+    if cached_message is not None:
+        return create_message_event_from_slack_message(bot, channel_id, cached_message)
+
     message_info = MessageEvent()
     response = bot.bot_client.conversations_history(channel=channel_id, latest=message_id, inclusive=True, include_all_metadata=True, limit=1)
     if not response["ok"]:
@@ -164,7 +158,7 @@ def get_message_info(bot: UserInfo, channel_id: str, message_id: str) -> Message
         return None
 
     message_content = response["messages"][0]
-    message_info = _create_message_event_from_slack_message(bot, channel_id, message_content)    
+    message_info = create_message_event_from_slack_message(bot, channel_id, message_content)    
     return message_info
 
 
@@ -178,7 +172,7 @@ def get_messages_from_channel(bot: UserInfo, channel_id: str) -> list[MessageEve
         return None
     messages = []
     for message_content in response["messages"]:
-        message_info = _create_message_event_from_slack_message(bot, channel_id, message_content)
+        message_info = create_message_event_from_slack_message(bot, channel_id, message_content)
         messages.append(message_info)
 
     # Reverse the order of the messages because they're returned in reverse chronological order
@@ -186,61 +180,50 @@ def get_messages_from_channel(bot: UserInfo, channel_id: str) -> list[MessageEve
     return messages
 
 def get_messages_from_thread(bot: UserInfo, channel_id: str, thread_id: str) -> list[MessageEvent]:
-    response = bot.bot_client.conversations_replies(channel=channel_id, ts=thread_id, inclusive= True, include_all_metadata=True, limit=1000)
-    if not response["ok"]:
-        logging.error(f"Error getting messages from thread {thread_id}: {response['error']}")
-        return None
-    if not 'messages' in response:
-        logging.error(f"No messages found for thread {thread_id}")
+    snapshot = get_thread_snapshot(bot, channel_id, thread_id)
+    if snapshot is None:
         return None
-    messages = []
-    for message_content in response["messages"]:
-        message_info = _create_message_event_from_slack_message(bot, channel_id, message_content)
-        messages.append(message_info)
-
-    # Reverse the order of the messages because they're returned in reverse chronological order
-    return messages
+    return [create_message_event_from_slack_message(bot, channel_id, message_content) for message_content in snapshot.message_list()]
 
 def get_thread_participants(bot:UserInfo, channel_id:str, thread_id:str) -> list[str]:
     try:
-        # Fetch all messages from the thread
-        result = bot.bot_client.conversations_replies(channel=channel_id, ts=thread_id)
-        if not result['ok']:
-            logging.error(f"Error fetching thread messages: {result['error']}")
+        snapshot = get_thread_snapshot(bot, channel_id, thread_id)
+        if snapshot is None:
             return []
 
         # Extract unique user IDs from the messages
-        user_ids = set(message.get('user') for message in result['messages'])
-        return list(user_ids)
+        return snapshot.participants()
 
     except Exception as e:
+        # Let the outbound queue retry rate-limited fetches.
+        if slack_retry_after(e) is not None:
+            raise
         logging.error(f"Error in get_thread_participants: {str(e)}")
         return []
 
 
-async def get_previous_messages(bot, channel_id, message_ts=None, thread_ts=None):
+def get_previous_messages(bot, channel_id, message_ts=None, thread_ts=None):
     try:
-        result = bot.bot_client.conversations_replies(channel=channel_id, ts=thread_ts)
-        if not result['ok']:
-            logging.error(f"Error fetching thread messages: {result['error']}")
+        snapshot = get_thread_snapshot(bot, channel_id, thread_ts)
+        if snapshot is None:
             return []
 
-        messages = []
-        # Collect messages before the given message_ts
-        for msg in result['messages']:
-            message_event = _create_message_event_from_slack_message(bot,channel_id, msg)
-            messages.append(message_event)
-
-        return messages
+        # Messages the conversation state already has are skipped by id.
+        return [create_message_event_from_slack_message(bot, channel_id, msg) for msg in snapshot.message_list()]
 
     except Exception as e:
+        # Let the outbound queue retry rate-limited fetches.
+        if slack_retry_after(e) is not None:
+            raise
         logging.error(f"Error in get_previous_messages_slack: {str(e)}")
         return []
 
 
 
 slack_bot_function_handler = ProviderFunctionsBase()
+slack_bot_function_handler.max_message_length = 4000
 slack_bot_function_handler.send_message = send_message
+slack_bot_function_handler.update_message = update_message
 slack_bot_function_handler.add_reaction = add_reaction
 slack_bot_function_handler.remove_reaction = remove_reaction
 slack_bot_function_handler.get_user_info = get_user_info
@@ -249,27 +232,19 @@ slack_bot_function_handler.get_messages_from_channel = get_messages_from_channel
 slack_bot_function_handler.get_messages_from_thread = get_messages_from_thread
 slack_bot_function_handler.get_thread_participants = get_thread_participants
 slack_bot_function_handler.get_previous_messages = get_previous_messages
+if OutboundQueue.OUTBOUND_QUEUE:
+    slack_bot_function_handler.outbound_queue = OutboundQueue.OutboundQueue("slack", SLACK_RATE_LIMITS, channel_limits=SLACK_CHANNEL_RATE_LIMITS, get_retry_after=slack_retry_after)
 
 # -- Internal Helpers --
 def _get_bot_info(context):
-    global slack_bot_function_handler
-    bot_info = UserInfo()
-    bot_info.id = context.bot_user_id
-    bot_info.platform = "slack"
-    bot_info.mention_tag = f"<@{context.bot_user_id}>"
-    bot_info.username = "Slack Bot"
-    bot_info.real_name = "Slackery Bottonson"
-    bot_info.title = "Slack Bot"
-    bot_info.is_bot = True
-    bot_info.bot_client = app.client
-    bot_info.bot_functions = slack_bot_function_handler
-    return bot_info
+    return create_bot_info(context, app.client, slack_bot_function_handler)
 
 
 # -- Event Handlers --
 
 @app.event("message")
 def handle_message_events(event, say, context):
+    update_thread_snapshot(event)
     # Ignore deleted and changed messages
     if event.get('subtype', None) == 'message_deleted' or event.get('subtype', None) == 'message_changed':
         return
@@ -279,7 +254,7 @@ def handle_message_events(event, say, context):
 
     bot_info = _get_bot_info(context)
 
-    event_info = _create_message_event_from_slack_message(bot_info, event.get("channel",None), event)
+    event_info = create_message_event_from_slack_message(bot_info, event.get("channel",None), event)
 
     # Schedule the async event_handler to run asynchronously
     asyncio.run_coroutine_threadsafe(event_handler(bot_info, "message", event_info), new_loop)
@@ -287,10 +262,7 @@ def handle_message_events(event, say, context):
 @app.event("reaction_added")
 def handle_reaction_added_events(event, say, context):
     bot_info = _get_bot_info(context)    
-    reaction_info = ReactionEvent()
-    reaction_info.reaction = event["reaction"]
-    reaction_info.user_id = event["user"]
-    reaction_info.message_id = event["item"]["ts"]
+    reaction_info = create_reaction_added_event(event)
     asyncio.run_coroutine_threadsafe(event_handler(bot_info, "reaction_added", reaction_info), new_loop)
 
 
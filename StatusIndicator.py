@@ -0,0 +1,95 @@
+# Workflow phase indicators.
+# While a request is processed, its current phase is shown as a reaction on the user's message. Reactions are updated
+# by a background task per message instead of being awaited by the workflow. That task makes at most one API call at a
+# time, always moves straight to the latest phase, and skips phases that end within STATUS_DEBOUNCE_MS.
+import os
+import asyncio
+import logging
+
+from BotData import UserInfo, MessageEvent, ReactionEvent
+
+STATUS_DEBOUNCE = float(os.environ.get("STATUS_DEBOUNCE_MS", "500")) / 1000
+
+
+class StatusIndicator:
+    def __init__(self, bot_info: UserInfo, message_event: MessageEvent):
+        self.bot_info = bot_info
+        self.message_event = message_event
+        self.desired = None  # phase that should be shown
+        self.shown = None  # phase currently shown
+        self.final = False
+        self.changed_at = 0.0
+        self.task = None
+        self.stats = {'requested': 0, 'skipped': 0, 'api_calls': 0}
+
+    def set_phase(self, phase, final=False):
+        self.stats['requested'] += 1
+        # Nothing was ever shown for the phase we're replacing.
+        if self.desired is not None and self.desired != self.shown:
+            self.stats['skipped'] += 1
+        self.desired = phase
+        self.final = final
+        self.changed_at = asyncio.get_running_loop().time()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    def _reaction(self, phase):
+        return ReactionEvent(reaction=phase,message_id=self.message_event.message_id,channel_id=self.message_event.channel_id,user_id=self.bot_info.id,message_owner_id=self.message_event.user_id)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        functions = self.bot_info.bot_functions
+        while self.shown != self.desired:
+            # Wait until the phase has lasted long enough to be worth showing; final phases are shown right away.
+            if not self.final:
+                delay = self.changed_at + STATUS_DEBOUNCE - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+            desired = self.desired
+            try:
+                # Show the new phase before removing the old one, so the message is never without a status.
+                if desired is not None:
+                    self.stats['api_calls'] += 1
+                    await functions.call_add_reaction(self.bot_info, self._reaction(desired))
+                if self.shown is not None:
+                    self.stats['api_calls'] += 1
+                    await functions.call_remove_reaction(self.bot_info, self._reaction(self.shown))
+            except Exception as e:
+                logging.error(f"Error updating status of message {self.message_event.message_id} to {desired}: {e}")
+            self.shown = desired
+
+
+# (platform, channel id, message id) -> StatusIndicator of requests in progress
+_indicators = {}
+
+
+def _key(bot_info: UserInfo, message_event: MessageEvent):
+    return (bot_info.platform, message_event.channel_id, message_event.message_id)
+
+
+def get_indicator(bot_info: UserInfo, message_event: MessageEvent) -> StatusIndicator:
+    key = _key(bot_info, message_event)
+    indicator = _indicators.get(key)
+    if indicator is None:
+        indicator = StatusIndicator(bot_info, message_event)
+        _indicators[key] = indicator
+    return indicator
+
+
+def set_phase(bot_info: UserInfo, message_event: MessageEvent, phase):
+    """ Shows phase as the status of message_event. Returns immediately. """
+    get_indicator(bot_info, message_event).set_phase(phase)
+
+
+def finish(bot_info: UserInfo, message_event: MessageEvent, phase):
+    """ Shows the final status of message_event right away and forgets its indicator once that's done. Returns immediately. """
+    key = _key(bot_info, message_event)
+    indicator = get_indicator(bot_info, message_event)
+    indicator.set_phase(phase, final=True)
+
+    def forget(task):
+        if _indicators.get(key) is indicator and indicator.final:
+            del _indicators[key]
+            logging.debug(f"Status updates for message {message_event.message_id}: {indicator.stats}")
+    indicator.task.add_done_callback(forget)
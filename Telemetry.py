@@ -0,0 +1,202 @@
+# Request tracing and metrics.
+# Each handled message gets a request id that's carried through the layers (and any tasks they start) in a context
+# variable. Work worth timing - workflow phases, provider calls, downloads, extraction, cache lookups and LLM calls - is
+# wrapped in a span, which logs a structured line with the request id and its parent span, and feeds a latency
+# histogram per span kind and name. Modules with their own counters (caches, queues) register collectors, and
+# everything is exported in the Prometheus text format over a local HTTP endpoint and/or to a file.
+import os
+import time
+import uuid
+import asyncio
+import logging
+import itertools
+import contextvars
+
+# Serve the metrics on http://TELEMETRY_METRICS_HOST:TELEMETRY_METRICS_PORT/metrics (0 disables the endpoint).
+TELEMETRY_METRICS_PORT = int(os.environ.get("TELEMETRY_METRICS_PORT", "0"))
+TELEMETRY_METRICS_HOST = os.environ.get("TELEMETRY_METRICS_HOST", "127.0.0.1")
+# Write the metrics to this file every TELEMETRY_METRICS_INTERVAL seconds (empty disables the file), e.g. for
+# node_exporter's textfile collector.
+TELEMETRY_METRICS_FILE = os.environ.get("TELEMETRY_METRICS_FILE", "")
+TELEMETRY_METRICS_INTERVAL = float(os.environ.get("TELEMETRY_METRICS_INTERVAL", "15"))
+METRIC_PREFIX = "neuronexus_"
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+request_id = contextvars.ContextVar("request_id", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+
+
+def new_request():
+    """ Starts a new request in the current context and returns its id. """
+    rid = uuid.uuid4().hex[:12]
+    request_id.set(rid)
+    return rid
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(HISTOGRAM_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+
+# (kind, name) -> Histogram of span durations, and the number of spans that ended with an exception
+_histograms = {}
+_errors = {}
+
+
+class span:
+    """ Times a block of work: `with Telemetry.span("llm", model):` (also usable with `async with`). """
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = str(name)
+        self.span_id = next(_span_ids)
+        self.parent = None
+
+    def __enter__(self):
+        self.parent = _current_span.get()
+        self.token = _current_span.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        duration = time.perf_counter() - self.start
+        try:
+            _current_span.reset(self.token)
+        except ValueError:
+            # Spans in async generators can end in a different context than they started in.
+            pass
+        key = (self.kind, self.name)
+        if key not in _histograms:
+            _histograms[key] = Histogram()
+        _histograms[key].observe(duration)
+        status = "ok"
+        if exc_type is not None and not issubclass(exc_type, (GeneratorExit, asyncio.CancelledError)):
+            status = "error"
+            _errors[key] = _errors.get(key, 0) + 1
+        logging.debug(f"span request={request_id.get()} id={self.span_id} parent={self.parent.span_id if self.parent else None} "
+                      f"kind={self.kind} name={self.name} status={status} duration_ms={duration * 1000:.1f}")
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        return self.__exit__(exc_type, exc, traceback)
+
+
+# Functions returning (metric name, type, labels, value) samples, called on every export.
+_collectors = []
+
+
+def register_collector(collector):
+    _collectors.append(collector)
+
+
+# cache name -> its stats dict, with 'hits', 'misses' and 'evictions' counters
+_caches = {}
+
+
+def cache_hit_ratio(cache):
+    stats = _caches[cache]
+    lookups = stats['hits'] + stats['misses']
+    return stats['hits'] / lookups if lookups else 0.0
+
+
+def register_cache(cache, stats):
+    """ Exports the hits, misses and evictions in a cache's stats dict, and its hit ratio. """
+    _caches[cache] = stats
+
+    def collect():
+        samples = [(f"cache_{counter}_total", "counter", {'cache': cache}, stats[counter]) for counter in ('hits', 'misses', 'evictions')]
+        samples.append(("cache_hit_ratio", "gauge", {'cache': cache}, cache_hit_ratio(cache)))
+        return samples
+    register_collector(collect)
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    return "{" + ",".join(f'{key}="{_label_value(value)}"' for key, value in labels.items()) + "}" if labels else ""
+
+
+def render_metrics() -> str:
+    """ Returns all metrics in the Prometheus text exposition format. """
+    lines = [f"# TYPE {METRIC_PREFIX}span_duration_seconds histogram"]
+    for (kind, name), histogram in sorted(_histograms.items()):
+        labels = {'kind': kind, 'name': name}
+        for bound, count in zip(HISTOGRAM_BUCKETS, histogram.buckets):
+            lines.append(f"{METRIC_PREFIX}span_duration_seconds_bucket{_labels(dict(labels, le=bound))} {count}")
+        lines.append(f"{METRIC_PREFIX}span_duration_seconds_bucket{_labels(dict(labels, le='+Inf'))} {histogram.count}")
+        lines.append(f"{METRIC_PREFIX}span_duration_seconds_sum{_labels(labels)} {histogram.sum}")
+        lines.append(f"{METRIC_PREFIX}span_duration_seconds_count{_labels(labels)} {histogram.count}")
+    lines.append(f"# TYPE {METRIC_PREFIX}span_errors_total counter")
+    for (kind, name), count in sorted(_errors.items()):
+        lines.append(f"{METRIC_PREFIX}span_errors_total{_labels({'kind': kind, 'name': name})} {count}")
+
+    # Samples of the same metric must be listed together, under one TYPE line.
+    metrics = {}
+    for collector in _collectors:
+        try:
+            for metric, metric_type, labels, value in collector():
+                metrics.setdefault(metric, (metric_type, []))[1].append((labels, value))
+        except Exception as e:
+            logging.error(f"Error collecting metrics: {e}")
+    for metric, (metric_type, samples) in sorted(metrics.items()):
+        lines.append(f"# TYPE {METRIC_PREFIX}{metric} {metric_type}")
+        lines.extend(f"{METRIC_PREFIX}{metric}{_labels(labels)} {value}" for labels, value in samples)
+    return "\n".join(lines) + "\n"
+
+
+async def _serve_metrics():
+    from aiohttp import web
+
+    async def metrics(request):
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, TELEMETRY_METRICS_HOST, TELEMETRY_METRICS_PORT).start()
+    logging.info(f"Serving metrics on http://{TELEMETRY_METRICS_HOST}:{TELEMETRY_METRICS_PORT}/metrics")
+
+
+async def _write_metrics_file():
+    while True:
+        await asyncio.sleep(TELEMETRY_METRICS_INTERVAL)
+        try:
+            # Written to a temporary file first, so readers never see a partial file.
+            text = render_metrics()
+            temporary_path = TELEMETRY_METRICS_FILE + ".tmp"
+            with open(temporary_path, "w") as f:
+                f.write(text)
+            os.replace(temporary_path, TELEMETRY_METRICS_FILE)
+        except OSError as e:
+            logging.error(f"Error writing metrics to {TELEMETRY_METRICS_FILE}: {e}")
+
+
+_exporters = []
+_exporters_started = False
+
+
+def start_exporters():
+    """ Starts the configured metrics exporters on the running event loop, once. """
+    global _exporters_started
+    if _exporters_started:
+        return
+    _exporters_started = True
+    if TELEMETRY_METRICS_PORT:
+        _exporters.append(asyncio.create_task(_serve_metrics()))
+    if TELEMETRY_METRICS_FILE:
+        _exporters.append(asyncio.create_task(_write_metrics_file()))
@@ -1,31 +1,71 @@
 # Management of the User Personality Profile
+# Profiles are stored one row per user in a WAL-mode SQLite database, so the Slack and Discord bot processes can
+# read and update them at the same time, and an update only rewrites the row that changed.
 import os
 import json
+import logging
+import threading
 import LocalData
 from BotData import UserInfo
 
+USER_INFO_DB_NAME = "userinfo_cache.db"
+# The previous single-file JSON cache. It is imported into the database the first time the database is created.
 USER_INFO_CACHE_PATH = os.path.join(LocalData.CACHE_PATH, "userinfo_cache.json")
 
-def load_userinfo_cache():
-    if os.path.exists(USER_INFO_CACHE_PATH):
+# Runtime-only fields that can't (and shouldn't) be persisted.
+TRANSIENT_FIELDS = ('bot_client', 'bot_functions')
+
+_db = None
+_db_lock = threading.Lock()
+
+
+def _serialize_userinfo(userinfo):
+    data = userinfo.to_dict()
+    for key in TRANSIENT_FIELDS:
+        data.pop(key, None)
+    return json.dumps(data)
+
+
+def _import_json_cache(db):
+    if not os.path.exists(USER_INFO_CACHE_PATH):
+        return
+    try:
         with open(USER_INFO_CACHE_PATH, "r") as f:
             data = json.load(f)
-            return {str(user_id): UserInfo.from_dict(user_data) for user_id, user_data in data.items()}
-    return {}
+        rows = [(str(user_id), _serialize_userinfo(UserInfo.from_dict(user_data))) for user_id, user_data in data.items()]
+        # Don't overwrite anything another process may already have written.
+        db.executemany("INSERT OR IGNORE INTO users (id, data) VALUES (?, ?)", rows)
+        logging.info(f"Imported {len(rows)} user profiles from {USER_INFO_CACHE_PATH}")
+    except (OSError, ValueError, TypeError) as e:
+        logging.error(f"Error importing user profiles from {USER_INFO_CACHE_PATH}: {e}")
+
+
+def _get_db():
+    # The database is opened lazily on first use.
+    global _db
+    if _db is None:
+        db = LocalData.open_cache_db(USER_INFO_DB_NAME)
+        with db:
+            exists = db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchone()
+            db.execute("CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+            if not exists:
+                _import_json_cache(db)
+        _db = db
+    return _db
 
-def save_userinfo_cache(cache):
-    with open(USER_INFO_CACHE_PATH, "w") as f:
-        # Ensure user IDs are converted to strings for consistency
-        json.dump({str(user_id): user_info.to_dict() for user_id, user_info in cache.items()}, f, indent=4)
 
 def add_userinfo_to_cache(userinfo):
     # Ensure userinfo.id is a string for consistency
-    USERINFO_CACHE[str(userinfo.id)] = userinfo
-    save_userinfo_cache(USERINFO_CACHE)
+    with _db_lock:
+        db = _get_db()
+        with db:
+            db.execute("INSERT INTO users (id, data) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET data = excluded.data", (str(userinfo.id), _serialize_userinfo(userinfo)))
+
 
 def lookup_userinfo(user_id):
     # Convert user_id to string for lookup to maintain consistency
-    return USERINFO_CACHE.get(str(user_id), None)
-
-USERINFO_CACHE = load_userinfo_cache()
-
+    with _db_lock:
+        row = _get_db().execute("SELECT data FROM users WHERE id = ?", (str(user_id),)).fetchone()
+    if row is None:
+        return None
+    return UserInfo.from_dict(json.loads(row[0]))
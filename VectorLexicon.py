@@ -1,41 +1,224 @@
 import os
-from sklearn.feature_extraction.text import CountVectorizer
+import gc
+from sklearn.feature_extraction.text import HashingVectorizer
 import numpy as np
 import re
 import pickle
+import LexiconFormat
+
+# Splits text at every regex word boundary (\b), so runs of word and non-word characters alternate.
+SEGMENT_PATTERN = re.compile(r'\w+|\W+')
+WORD_PATTERN = re.compile(r'\w')
+# Segments are never empty, so the empty string can mark the end of a key in the trie.
+TRIE_TERMINAL = ""
+
+# Size of the hashed character n-gram vectors used for similarity search.
+VECTOR_FEATURES = 512
+# Number of index rows scored at a time, which bounds the memory used by a search.
+SEARCH_CHUNK_ROWS = 65536
+
+
+def make_vectorizer(n_features=VECTOR_FEATURES):
+    # Hashing keeps the vectorizer stateless, so new definitions can be indexed without refitting anything.
+    return HashingVectorizer(analyzer='char_wb', ngram_range=(3, 5), n_features=n_features, alternate_sign=False, norm=None, dtype=np.float32)
+
+
+class TermMatcher:
+    """ A trie over boundary-delimited segments that finds every term and alias in a prompt in a single pass. """
+    def __init__(self, keys=()):
+        self.root = {}
+        # Building allocates a dict per trie node; pausing the cyclic GC keeps bulk builds from thrashing it.
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for key in keys:
+                self.add(key)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+    def add(self, key):
+        segments = SEGMENT_PATTERN.findall(key)
+        if not segments:
+            return
+        node = self.root
+        for segment in segments:
+            node = node.setdefault(segment, {})
+        node[TRIE_TERMINAL] = key
+
+    def find(self, text):
+        """ Returns every key found in text with the same whole-word semantics as r'\bkey\b', in order of occurrence. """
+        segments = SEGMENT_PATTERN.findall(text)
+        is_word = [WORD_PATTERN.match(segment) is not None for segment in segments]
+        last = len(segments) - 1
+        found = []
+        for start in range(len(segments)):
+            # Every segment start is a word boundary, except the start of the text when it begins with a non-word character.
+            if start == 0 and not is_word[0]:
+                continue
+            node = self.root
+            for end in range(start, len(segments)):
+                node = node.get(segments[end])
+                if node is None:
+                    break
+                key = node.get(TRIE_TERMINAL)
+                # Likewise, the end of the text is only a boundary after a word character.
+                if key is not None and (end < last or is_word[end]):
+                    found.append(key)
+        return found
+
+
+class SpanMatcher:
+    """ Finds keys by looking up every candidate span of the prompt. Used with memory-mapped lexicons, where building
+    a trie would mean reading every key at load time. """
+    def __init__(self, tables, max_key_segments):
+        self.tables = tables
+        self.max_key_segments = max_key_segments
+
+    def find(self, text):
+        """ Same results as TermMatcher.find. """
+        segments = SEGMENT_PATTERN.findall(text)
+        is_word = [WORD_PATTERN.match(segment) is not None for segment in segments]
+        last = len(segments) - 1
+        found = []
+        for start in range(len(segments)):
+            if start == 0 and not is_word[0]:
+                continue
+            key = ""
+            for end in range(start, min(len(segments), start + self.max_key_segments)):
+                key += segments[end]
+                if (end < last or is_word[end]) and any(key in table for table in self.tables):
+                    found.append(key)
+        return found
+
 
 class VectorLexicon:
     def __init__(self, filepath=None):
         # Initialize a dictionary to simulate VectorDB and vectorizer
         self.db = {}
         self.alias_terms = {}
+        # The term matcher is built on first use and then kept up to date by add_term/add_alias.
+        self.matcher = None
+        # Vector index: one L2-normalized row per definition, and the (term, definition number) each row belongs to.
+        self.vectorizer = make_vectorizer()
+        self.index = None
+        self.terms_index = []
+        # Definitions added since the index was last built. They are vectorized in one batch on the next search.
+        self.pending_index = []
+        # Set when the lexicon was loaded from a memory-mapped file; the tables above are then read-only views of it.
+        self.mapped = None
         self.filepath = filepath
         if self.filepath != None:
             self.load(filepath)
 
 
+    def materialize(self):
+        """ Copies a memory-mapped lexicon into regular dicts and lists so it can be modified. """
+        if self.mapped is None:
+            return
+        self.db = {term: self.db[term] for term in self.db}
+        self.alias_terms = {alias: self.alias_terms[alias] for alias in self.alias_terms}
+        self.terms_index = list(self.terms_index)
+        self.index = None if self.index is None else np.array(self.index)
+        self.matcher = None
+        self.mapped = None
+
+
     def add_term(self, term, definition, references=None):
+        self.materialize()
         if term not in self.db:
             self.db[term] = {'definitions': [], 'references': []}
+            if self.matcher is not None:
+                self.matcher.add(term)
         self.db[term]['definitions'].append(definition)
+        self.pending_index.append((term, len(self.db[term]['definitions']) - 1))
         if references:
             self.db[term]['references'].extend(references)
 
 
     def add_alias(self, alias, term):
         """ Adds an alias that refers to another term. """
+        self.materialize()
         if alias not in self.alias_terms:
             self.alias_terms[alias] = []
+            if self.matcher is not None:
+                self.matcher.add(alias)
         self.alias_terms[alias].append(term)        
    
 
+    def get_matcher(self):
+        if self.matcher is None:
+            if self.mapped is not None:
+                self.matcher = SpanMatcher((self.db, self.alias_terms), self.mapped.max_key_segments)
+            else:
+                self.matcher = TermMatcher(list(self.db) + list(self.alias_terms))
+        return self.matcher
+
+
+    def vectorize(self, texts):
+        vectors = self.vectorizer.transform(texts).toarray()
+        # Sublinear term frequency, then L2 normalization so a dot product is the cosine similarity.
+        np.log1p(vectors, out=vectors)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        vectors /= norms
+        return vectors
+
+
+    def build_index(self):
+        """ Vectorizes any pending definitions and appends them to the index. """
+        if not self.pending_index:
+            return
+        texts = [f"{term}: {self.db[term]['definitions'][number]}" for term, number in self.pending_index]
+        vectors = self.vectorize(texts)
+        self.index = vectors if self.index is None else np.vstack((self.index, vectors))
+        self.terms_index.extend(self.pending_index)
+        self.pending_index = []
+
+
+    def search(self, queries, top_k=5):
+        """ Returns the top_k most similar definitions for each query as lists of {'term', 'meaning', 'score'}. """
+        self.build_index()
+        if self.index is None or not len(queries):
+            return [[] for _ in queries]
+        query_vectors = self.vectorize(queries)
+        top_k = min(top_k, self.index.shape[0])
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        # Score the index in chunks, keeping a running top_k per query.
+        for start in range(0, self.index.shape[0], SEARCH_CHUNK_ROWS):
+            scores = query_vectors @ self.index[start:start + SEARCH_CHUNK_ROWS].T
+            chunk_k = min(top_k, scores.shape[1])
+            rows = np.argpartition(-scores, chunk_k - 1, axis=1)[:, :chunk_k]
+            best_scores = np.hstack((best_scores, np.take_along_axis(scores, rows, axis=1)))
+            best_rows = np.hstack((best_rows, rows + start))
+            if best_scores.shape[1] > top_k:
+                keep = np.argpartition(-best_scores, top_k - 1, axis=1)[:, :top_k]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+
+        results = []
+        for scores, rows in zip(best_scores, best_rows):
+            order = np.argsort(-scores)
+            matches = []
+            for i in order:
+                term, number = self.terms_index[rows[i]]
+                matches.append({'term': term, 'meaning': self.db[term]['definitions'][number], 'score': float(scores[i])})
+            results.append(matches)
+        return results
+
+
+    def find_similar_terms(self, prompt, top_k=3, min_score=0.35):
+        """ Finds glossary entries related to the prompt even when the term itself isn't mentioned. """
+        return [match for match in self.search([prompt], top_k)[0] if match['score'] >= min_score]
+
+
     def find_relevant_terms(self, prompt):
         # Initialize the output dictionary.
         output = {}
 
-        # Compile a regular expression pattern to match whole words, taking into account multi-word terms.
-        pattern = r'\b(?:' + '|'.join(re.escape(term) for term in self.db) + r')\b'
-        matches = re.findall(pattern, prompt)
+        # Find every term and alias in the prompt in one pass over the precompiled matcher.
+        matches = list(dict.fromkeys(self.get_matcher().find(prompt)))
 
         # Handle matches of full terms.
         for match in matches:
@@ -47,11 +230,10 @@ class VectorLexicon:
                         output[ref] = [{'term': ref, 'meaning': ref_meaning} for ref_meaning in self.db[ref]['definitions']]
 
         # Handle aliases separately.
-        for alias, terms in self.alias_terms.items():
-            # Check if the alias is present as a whole word in the prompt.
-            if re.search(r'\b' + re.escape(alias) + r'\b', prompt):
+        for alias in matches:
+            if alias in self.alias_terms:
                 output[alias] = []
-                for term in terms:
+                for term in self.alias_terms[alias]:
                     output[alias].extend([{'term': term, 'meaning': meaning} for meaning in self.db[term]['definitions']])
 
         return output
@@ -78,7 +260,7 @@ class VectorLexicon:
                 print("Invalid Selction - Try Again")
 
     
-    def enrich_prompt(self, prompt, user_clarification=False):
+    def enrich_prompt(self, prompt, user_clarification=False, similar_top_k=3, min_similarity=0.35):
         relevant_terms = self.find_relevant_terms(prompt)
         terms_to_add = []
         for term in relevant_terms.keys():  
@@ -94,6 +276,12 @@ class VectorLexicon:
                     for current_match in relevant_terms[term]:
                         terms_to_add.append({'term':term,'name':current_match['term'],'meaning':current_match['meaning']})
 
+        # Add similar entries for terms that weren't mentioned by name.
+        if similar_top_k:
+            for match in self.find_similar_terms(prompt, similar_top_k, min_similarity):
+                if match['term'] not in relevant_terms:
+                    terms_to_add.append({'term':match['term'],'name':match['term'],'meaning':match['meaning']})
+
         # Now, update our prompt
         enriched_prompt = prompt
         for entry in terms_to_add:
@@ -104,16 +292,35 @@ class VectorLexicon:
         return enriched_prompt    
 
     def save(self, filepath):
-        """ Saves the current state of the lexicon and vectorizer to a file. """
-        with open(filepath, 'wb') as file:
-            pickle.dump((self.db, self.vectorizer, self.index, self.alias_terms, self.terms_index), file)
+        """ Saves the current state of the lexicon and its vector index to a memory-mappable file. """
+        self.build_index()
+        max_key_segments = max((len(SEGMENT_PATTERN.findall(key)) for key in list(self.db) + list(self.alias_terms)), default=1)
+        LexiconFormat.write_lexicon(filepath, self.db, self.alias_terms, self.index, self.terms_index, self.vectorizer.n_features, max_key_segments)
 
     def load(self, filepath):
-        """ Loads the lexicon and vectorizer state from a file. """
+        """ Loads the lexicon from a file, mapping it into memory rather than reading it. """
         if not os.path.exists(filepath):
             return False        
+        if not LexiconFormat.is_lexicon_file(filepath):
+            return self.load_pickle(filepath)
+        self.mapped = LexiconFormat.read_lexicon(filepath)
+        self.db = self.mapped.db
+        self.alias_terms = self.mapped.alias_terms
+        self.index = self.mapped.index
+        self.terms_index = self.mapped.terms_index
+        self.vectorizer = make_vectorizer(self.mapped.n_features)
+        self.matcher = None
+        self.pending_index = []
+        return True
+
+    def load_pickle(self, filepath):
+        """ Imports a lexicon saved in the legacy pickle format. Only load pickles you trust; save() to convert them. """
         with open(filepath, 'rb') as file:
             self.db, self.vectorizer, self.index, self.alias_terms, self.terms_index = pickle.load(file)    
+        self.matcher = None
+        self.mapped = None
+        self.pending_index = []
+        return True
 
 def new_test():
     pass
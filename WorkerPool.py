@@ -0,0 +1,66 @@
+# Management of the CPU worker pool.
+# CPU heavy work (OCR, PDF parsing) is sent to a pool of worker processes so it never blocks the event loop.
+# Functions sent to the pool must be module-level so they can be pickled, and live in light modules (like Extractors),
+# since each worker imports them. Workers are started from a fork server rather than forked from the bot, which by then
+# has threads whose locks a forked child could inherit held.
+import os
+import asyncio
+import multiprocessing
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+CPU_WORKER_POOL_SIZE = int(os.environ.get("CPU_WORKER_POOL_SIZE", str(os.cpu_count() or 1)))
+CPU_TASK_TIMEOUT = float(os.environ.get("CPU_TASK_TIMEOUT", "60"))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool = ProcessPoolExecutor(max_workers=CPU_WORKER_POOL_SIZE, mp_context=multiprocessing.get_context(start_method))
+        return _pool
+
+
+def _retire_pool(pool, cancel_futures=True):
+    # Swap out a broken or stuck pool so new work lands on a fresh one.
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=cancel_futures)
+
+
+async def run_cpu_task(func, *args, timeout=None):
+    """ Runs func(*args) in the worker pool, retrying once if the pool dies underneath it. """
+    timeout = timeout or CPU_TASK_TIMEOUT
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = get_pool()
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(pool, func, *args), timeout)
+        except BrokenProcessPool:
+            # A worker crashed (e.g. a segfault in a native library). Work that was sharing the pool gets one retry.
+            logging.error(f"CPU worker pool crashed while running {func.__name__} (attempt {attempt + 1})")
+            _retire_pool(pool)
+            if attempt == 1:
+                raise
+        except asyncio.TimeoutError:
+            # A running task can't be interrupted, so its result is dropped. The old pool finishes the work it already
+            # has, this task included, and then its workers exit; new work goes to a fresh pool in the meantime.
+            logging.error(f"CPU task {func.__name__} timed out after {timeout}s, moving new work to a fresh worker pool")
+            _retire_pool(pool, cancel_futures=False)
+            raise
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,65 @@
+# Benchmarks VectorLexicon.find_relevant_terms lookup latency as the glossary grows.
+# Usage: python benchmarks/bench_vector_lexicon.py [term counts...]   (default: 1000 100000 1000000)
+import os
+import sys
+import time
+import random
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from VectorLexicon import VectorLexicon
+
+SYLLABLES = ["ka", "ro", "mi", "tan", "zu", "ex", "lo", "pri", "vo", "sen", "dra", "qui", "ne", "bal", "tor", "fy"]
+PROMPT_WORDS = 200
+LOOKUPS = 200
+
+
+def make_word(rng):
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+
+def make_lexicon(term_count, rng):
+    lexicon = VectorLexicon()
+    terms = []
+    for i in range(term_count):
+        # Roughly a third of the glossary is multi-word terms.
+        words = [make_word(rng) for _ in range(rng.choice((1, 1, 2, 3)))]
+        term = " ".join(words) + str(i)
+        terms.append(term)
+        lexicon.add_term(term, f"Definition of {term}")
+        if i % 10 == 0:
+            lexicon.add_alias(f"{words[0]}_alias{i}", term)
+    return lexicon, terms
+
+
+def make_prompt(terms, rng):
+    words = [make_word(rng) for _ in range(PROMPT_WORDS)]
+    for _ in range(5):
+        words.insert(rng.randrange(len(words)), rng.choice(terms))
+    return " ".join(words) + "?"
+
+
+def bench(term_count):
+    rng = random.Random(term_count)
+    lexicon, terms = make_lexicon(term_count, rng)
+    start = time.perf_counter()
+    lexicon.get_matcher()
+    build_time = time.perf_counter() - start
+
+    prompts = [make_prompt(terms, rng) for _ in range(LOOKUPS)]
+    timings = []
+    for prompt in prompts:
+        start = time.perf_counter()
+        found = lexicon.find_relevant_terms(prompt)
+        timings.append(time.perf_counter() - start)
+        assert len(found) >= 1
+    timings.sort()
+    p50 = statistics.median(timings) * 1000
+    p95 = timings[int(len(timings) * 0.95) - 1] * 1000
+    print(f"{term_count:>10} terms | build {build_time:8.2f}s | lookup p50 {p50:7.3f}ms p95 {p95:7.3f}ms")
+
+
+if __name__ == "__main__":
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000, 100000, 1000000]
+    for count in counts:
+        bench(count)
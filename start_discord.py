@@ -3,8 +3,8 @@ from dotenv import load_dotenv
 import LocalData
 load_dotenv(LocalData.ENV_PATH)
 
-from ChatBot import run_discord
-
 if __name__ == "__main__":
+    # Imported here, so the CPU worker processes (which import this script) don't load the whole bot.
+    from ChatBot import run_discord
     run_discord()
 